@@ -0,0 +1,89 @@
+import argparse
+import os
+import shutil
+import time
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score, rand_score
+
+from main import (draft_quality, kmeans_clustering, load_base_pipeline, load_feature_extractor,
+                  most_cohesive_cluster)
+from utils.common import config2args
+from utils.generation import AdaptiveBatchSize, iter_pool_images
+from utils.logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+cmd_parser = argparse.ArgumentParser(description="Compare draft pools to full quality pools: speed and clusterings.")
+cmd_parser.add_argument('-c', '--config_file', type=str)
+cmd_parser.add_argument('-n', '--num_images', type=int, default=None, help='Pool size, `num_of_generated_img` by default.')
+cmd_parser.add_argument('-r', '--repeats', type=int, default=3, help='Pools of different seeds.')
+cmd_parser.add_argument('-o', '--output_dir', type=str, default='./out/benchmark/draft')
+cmd_args = cmd_parser.parse_args()
+
+args = config2args(cmd_args.config_file)
+args.draft_pool = True
+if cmd_args.num_images is not None:
+    args.num_of_generated_img = cmd_args.num_images
+args.kmeans_center = int(args.num_of_generated_img / args.dsize_c)
+quality = draft_quality(args)
+
+pipe = load_base_pipeline(args)
+feat_extractor = load_feature_extractor(args)
+batch_size = AdaptiveBatchSize(getattr(args, "gen_batch_size", 1), getattr(args, "gen_max_batch_size", None))
+
+
+def render_and_embed(pool_dir, pool_id, **pool_quality):
+    """render a whole pool and embed it, the pool directory is emptied first so that every image is rendered"""
+    # the images of a previous run would otherwise be loaded instead, and timed as decoding
+    if os.path.exists(pool_dir):
+        shutil.rmtree(pool_dir)
+    os.makedirs(pool_dir)
+    start = time.perf_counter()
+    images = []
+    for _, image, is_new in iter_pool_images(pipe, args, pool_dir, pool_id, batch_size=batch_size, **pool_quality):
+        assert is_new
+        images.append(image)
+    elapsed = time.perf_counter() - start
+    for img_id, image in enumerate(images):
+        image.save(os.path.join(pool_dir, f"{img_id}.png"))
+    return elapsed, feat_extractor(images)
+
+
+def cluster_labels(embeddings):
+    """cluster labels of every pool image, -1 for the images of the dropped small clusters, and the selected images"""
+    centers, labels, elements, indices = kmeans_clustering(args, embeddings)
+    all_labels = np.full(len(embeddings), -1)
+    all_labels[indices] = labels
+    return all_labels, set(most_cohesive_cluster(centers, labels, elements, indices).tolist())
+
+
+results = []
+for pool_id in range(cmd_args.repeats):
+    # the pools are rendered from scratch, loop ids only pick other seeds
+    pool_root = os.path.join(cmd_args.output_dir, args.character_name, str(pool_id))
+    full_time, full_embs = render_and_embed(os.path.join(pool_root, "full"), pool_id)
+    draft_time, draft_embs = render_and_embed(os.path.join(pool_root, "draft"), pool_id, **quality)
+
+    full_assign, full_selected = cluster_labels(full_embs)
+    draft_assign, draft_selected = cluster_labels(draft_embs)
+    jaccard = len(full_selected & draft_selected) / max(len(full_selected | draft_selected), 1)
+    results.append((full_time, draft_time, rand_score(full_assign, draft_assign),
+                    adjusted_rand_score(full_assign, draft_assign), jaccard, len(draft_selected) / len(draft_embs)))
+    log.info((f"Pool {pool_id}: full {full_time:.1f}s, draft {draft_time:.1f}s ({full_time / draft_time:.2f}x), "
+              f"rand index {results[-1][2]:.3f}, adjusted {results[-1][3]:.3f}, "
+              f"selected cluster overlap (jaccard) {jaccard:.3f}"))
+
+full_time, draft_time, rand, ari, jaccard, selected_share = np.array(results).T
+# re-rendering the selected images at full quality is part of the draft cost
+rerender_time = (selected_share * full_time).sum()
+log.info((f"Draft pools ({quality['infer_steps'] or args.infer_steps} steps, resolution {quality['resolution'] or 'default'}) "
+          f"over {cmd_args.repeats} pools of {args.num_of_generated_img} images: "
+          f"rendering speedup {full_time.sum() / draft_time.sum():.2f}x "
+          f"({full_time.sum() / (draft_time.sum() + rerender_time):.2f}x with the full quality "
+          f"re-render of the selected cluster), "
+          f"rand index {rand.mean():.3f}, adjusted rand index {ari.mean():.3f}, "
+          f"selected cluster overlap {jaccard.mean():.3f}, same selection (overlap >= 0.5) in "
+          f"{(jaccard >= 0.5).mean() * 100:.0f}% of the pools"))
@@ -1,8 +1,7 @@
-from diffusers import DiffusionPipeline
-import torch
 import os
 import argparse
 
+from main import load_trained_pipeline
 from utils.common import config2args, log_print
 from utils.logger import get_logger
 
@@ -26,9 +25,8 @@ os.makedirs(output_dir, exist_ok=True)
 
 # Load models
 model_path = os.path.join(args.output_dir, args.character_name, str(cmd_args.loop_id))
-pipe = DiffusionPipeline.from_pretrained(model_path, torch_dtype=torch.float16)
-pipe.to("cuda")
-pipe.load_lora_weights(os.path.join(model_path, f"checkpoint-{args.checkpointing_steps * args.num_train_epochs}"))
+# the base pipeline with the adapters of the loop (lora weights and learned embeddings)
+pipe = load_trained_pipeline(args, model_path)
 
 # Infer
 for prompt_postfix in cmd_args.prompt_postfixes:
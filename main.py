@@ -5,6 +5,7 @@ import math
 import os
 import random
 import shutil
+import time
 from pathlib import Path
 from typing import Dict
 from torch.utils.data import Dataset
@@ -32,213 +33,642 @@ from diffusers.optimization import get_scheduler
 from diffusers.training_utils import compute_snr
 from diffusers.utils import check_min_version, is_wandb_available
 from diffusers.utils.import_utils import is_xformers_available
-from PIL import Image
 import PIL
 import safetensors
 import numpy as np
 from diffusers import DiffusionPipeline
-from sdxl_the_chosen_one import train as train_pipeline
+from sdxl_the_chosen_one import base_pipeline, base_weight_dtypes, reset_base_pipeline, train as train_pipeline
 import shutil
 from pathlib import Path
-import torchvision.transforms as T
-from sklearn.manifold import TSNE
-from sklearn.cluster import KMeans
-import matplotlib.pyplot as plt
-from scipy.spatial.distance import cdist
 
+from utils.adapters import base_fingerprint, load_adapter_manifest
+from utils.clustering import fit_kmeans
 from utils.common import config2args, log_print
+from utils.distance import SequentialConvergenceTest, pool_distance
+from utils.embedding_cache import EmbeddingCache
+from utils.features import FeatureExtractor
+from utils.generation import (AdaptiveBatchSize, derive_seed, generate_images_batched, is_oom_error,
+                              iter_pool_images)
+from utils.image_io import MATERIALIZE_MODES, ImageWriter, link_or_copy, save_image_atomic, write_manifest
 from utils.logger import get_logger
+from utils.pipeline import PipelineStage
+from utils.residency import ModelResidency
+from utils.run_state import RunState, config_hash
+from utils.scheduler import SCHEDULING_POLICIES, PhaseScheduler
+from utils.visualization import launch_plot_clusters, plot_clusters
+from utils.work_queue import WorkQueue, run_worker
 
 
-log = get_logger(__name__, dump_dir='./out/log')
+# the log is dumped to a file when the loop is run, not when another script imports the loaders
+log = get_logger(__name__, dump_dir='./out/log' if __name__ == "__main__" else None)
 
+# feature extractor, the identity also keys the embedding cache
+DINOV2_REPO = 'facebookresearch/dinov2'
+DINOV2_MODEL = 'dinov2_vitl14'
+DINOV2_INPUT_SIZE = 518
+DINOV2_ID = f"{DINOV2_REPO}/{DINOV2_MODEL}@{DINOV2_INPUT_SIZE}"
 
-def train_loop(args, loop_num: int, vis=True, start_from=0):
+
+def train_loop(args, loop_num: int, vis=True, start_from=None):
     """
     train and load the trained diffusion model, save the images and model file.
+    the run resumes from its run state, or runs again from the loop `start_from` if given.
+    """
+    phases = train_loop_phases(args, loop_num, vis=vis, start_from=start_from)
+    while True:
+        try:
+            next(phases)
+        except StopIteration as stop:
+            return stop.value
+
+
+def train_loop_phases(args, loop_num: int, vis=True, start_from=None, residency=None, queue=None):
+    """
+    the training loop as a generator yielding the name of every finished phase ('publish', 'generate', 'cluster', 'train'),
+    so that a scheduler can interleave the loops of several characters,
+    the models are taken from `residency` and the pools published to `queue` when they are shared
+    return: the final model directory, if converged
     """
     output_dir_base = args.output_dir
     train_data_dir_base = args.train_data_dir
     num_train_epochs = args.num_train_epochs
     checkpointing_steps = args.checkpointing_steps
+    run_config_hash = config_hash(args)
     
     args.kmeans_center = int(args.num_of_generated_img / args.dsize_c)
     
-    # initial pair wise distance
-    init_dist = 0
+    # mean pairwise distances are computed in tiles, or estimated from random pairs if `distance_num_pairs` > 0
+    distance_kwargs = dict(backend=getattr(args, "distance_backend", "numpy"),
+                           device=getattr(args, "distance_device", "cpu"),
+                           num_pairs=getattr(args, "distance_num_pairs", 0),
+                           seed=getattr(args, "seed", 0) or 0)
+    
+    # generation batch size, adapted to OOM errors and kept across loops
+    gen_batch_size = AdaptiveBatchSize(getattr(args, "gen_batch_size", 1),
+                                       getattr(args, "gen_max_batch_size", 2 * getattr(args, "gen_batch_size", 1)))
+    
+    # PNGs are encoded and written in the background, flushed before anything reads them
+    writer = ImageWriter(num_workers=getattr(args, "writer_num_workers", 4),
+                         max_in_flight=getattr(args, "writer_max_in_flight", 32))
+    
+    # pool embeddings are cached on disk, keyed by the image content
+    emb_cache = EmbeddingCache(
+        os.path.join(getattr(args, "embedding_cache_dir", "./out/data/embeddings"), args.character_name), DINOV2_ID)
+    
+    # dinov2 and the base SDXL pipeline are loaded once and kept across loops (and characters),
+    # moved to CPU memory during training instead of being destroyed
+    if residency is None:
+        residency = make_residency(args)
+    sdxl_key = base_pipeline_key(args)
+    residency.register("dinov2", load_dinov2)
+    residency.register(sdxl_key, lambda: load_base_pipeline(args))
+    
+    # with `pool_queue_dir`, the pools are rendered by worker processes (`--worker`) sharing the directory,
+    # this process only publishes the missing images and embeds the ones already in the pool
+    own_queue = queue is None and getattr(args, "pool_queue_dir", None) is not None
+    if own_queue:
+        queue = make_pool_queue(args)
+    
+    # progress of the run, saved after every phase, a run restarted with the same config resumes
+    # at its first unfinished phase without recomputing the initial distance,
+    # a given `start_from` (0 included) runs again from that loop and forgets the state of the later ones
+    run_state = RunState(os.path.join(output_dir_base, args.character_name, "run_state.json"), run_config_hash)
+    if start_from is not None:
+        run_state.reset_from(start_from)
+    if run_state.final_dir is not None:
+        log.info(f"Already converged. Final model saved at {run_state.final_dir}")
+        writer.close()
+        return run_state.final_dir
+    if start_from is None:
+        start_from = run_state.resume_loop()
+    init_dist = run_state.init_dist
     
     # start looping
-    for loop_id in range(start_from, loop_num):
-        log.info(f"[{loop_id}/{loop_num-1}] Start.")
+    try:
+        for loop_id in range(start_from, loop_num):
+            log.info(f"[{loop_id}/{loop_num-1}] Start.")
         
-        # load dinov2 every epoch, since we clean the model after feature extraction
-        dinov2 = load_dinov2()
+            # the diffusion pipeline for new training image generation, only the per-loop adapters are swapped
+            prev_output_dir = os.path.join(output_dir_base, args.character_name, str(loop_id - 1))
+            if loop_id == 0:
+                # plain SDXL
+                adapters = {}
+            else:
+                # Note that these configurations are changned during training.
+                # Since the the training is epoch based and we use iterations, the diffuser training script automatically calculate a new epoch according to the iteration and dataset size, thus the predefined epoches will be overrided.
+                # Load the adapters from the output dir in PREVIOUS loop, at the checkpoint recorded by its training
+                ckpt_dir = run_state.loop(loop_id - 1).get("checkpoint_dir") or os.path.join(
+                    prev_output_dir, f"checkpoint-{checkpointing_steps * num_train_epochs}")
+                adapters = dict(lora_path=os.path.abspath(ckpt_dir), embeds_dir=os.path.abspath(prev_output_dir))
         
-        # load diffusion pipeline every epoch for new training image generation, since we clean the model after feature extraction
-        prev_output_dir = os.path.join(output_dir_base, args.character_name, str(loop_id - 1))
-        if loop_id == 0:
-            # load from default SDXL config.
-            pipe = load_trained_pipeline()
-        else:
-            # Note that these configurations are changned during training.
-            # Since the the training is epoch based and we use iterations, the diffuser training script automatically calculate a new epoch according to the iteration and dataset size, thus the predefined epoches will be overrided.
-            # Load model from the output dir in PREVIOUS loop
-            ckpt_dir = os.path.join(prev_output_dir, f"checkpoint-{checkpointing_steps * num_train_epochs}")
-            pipe = load_trained_pipeline(model_path=prev_output_dir, load_lora=True, lora_path=ckpt_dir)
+            # update model output dir for CURRENT loop
+            args.output_dir_per_loop = os.path.join(output_dir_base, args.character_name, str(loop_id))
+            args.train_data_dir_per_loop = os.path.join(train_data_dir_base, args.character_name, str(loop_id))
+            # the training images always come from the full quality pool
+            args.train_latents_dir_per_loop = latents_dir_of(args, pool_dir_of(args, loop_id))
         
-        # update model output dir for CURRENT loop
-        args.output_dir_per_loop = os.path.join(output_dir_base, args.character_name, str(loop_id))
+            if run_state.is_done(loop_id, "cluster"):
+                # the training set of this loop is ready, go straight to the training
+                selected_indices = run_state.loop(loop_id)["selected_indices"]
+                log.info(f"[{loop_id}/{loop_num-1}] Resumed with the training set of {len(selected_indices)} images.")
+                if not os.path.isdir(args.train_data_dir_per_loop) or not os.listdir(args.train_data_dir_per_loop):
+                    # the training directory is gone, the selected images are still in the full quality pool
+                    os.makedirs(args.train_data_dir_per_loop, exist_ok=True)
+                    materialize_training_set([os.path.join(pool_dir_of(args, loop_id), f"{i}.png") for i in selected_indices],
+                                             args.train_data_dir_per_loop,
+                                             mode=getattr(args, "train_data_mode", "hardlink"), writer=writer)
+                    writer.flush()
+                    log.info(f"[{loop_id}/{loop_num-1}] Restored the training set in '{args.train_data_dir_per_loop}'.")
+            else:
+                # set up the pool directory storing the generated images
+                # (from which training data are chosen)
+                # draft pools (`draft_pool`) have their own directories, next to the full quality ones
+                quality = draft_quality(args)
+                pool_dir = pool_dir_of(args, loop_id, quality)
+                loop0_pool_dir = pool_dir_of(args, 0, quality)
+                os.makedirs(pool_dir, exist_ok=True)
         
-        # set up the pool directory storing the generated images
-        # (from which training data are chosen)
-        pool_dir = f"{args.backup_data_dir_root}/{args.character_name}/{loop_id}"
-        loop0_pool_dir = f"{args.backup_data_dir_root}/{args.character_name}/0"
-        os.makedirs(pool_dir, exist_ok=True)
+                pool_paths = [os.path.join(pool_dir, f"{img_id}.png") for img_id in range(args.num_of_generated_img)]
+                if run_state.is_done(loop_id, "generate") and all(os.path.exists(p) for p in pool_paths):
+                    # the pool of this loop was generated and did not converge, cluster it again from the cached
+                    # embeddings, without the diffusion pipeline, dinov2 is only loaded for the images the cache misses
+                    img_paths, embeddings = load_pool_embeddings(args, pool_paths, residency, cache=emb_cache,
+                                                                 cache_name=os.path.basename(pool_dir))
+                    log.info(f"[{loop_id}/{loop_num-1}] Resumed with the generated pool of {len(img_paths)} images.")
+                else:
+                    # the workers render the missing images while the other characters run their phases
+                    pipe = None
+                    if queue is None:
+                        pipe = residency.acquire(sdxl_key)
+                        swap_loop_adapters(pipe, args, **adapters)
+                    else:
+                        job_name, missing = publish_pool_job(queue, args, pool_dir, loop_id, adapters=adapters, quality=quality)
+                        yield "publish"
         
-        # generate new images
-        image_embs = []
-        images = []
-        for n_img in range(args.num_of_generated_img):
-            log.info((f"LP {loop_id:4>}/{loop_num-1:4<} "
-                      f"generating IMG {n_img:4>}/{args.num_of_generated_img - 1:4<}"))
-            
-            # set up different seeds for each image
-            torch.manual_seed(n_img * np.random.randint(1000))
-            
-            # the generated images could be loaded from local backup folder
-            # if it exists already
-            img_path = os.path.join(pool_dir, f"{n_img}.png")
-            if os.path.exists(img_path):
-                image = Image.open(os.path.join(pool_dir, f"{n_img}.png")).convert('RGB')
-            else:
-                image = generate_images(pipe, prompt=args.inference_prompt, infer_steps=args.infer_steps)
-                image.save(img_path)
-                
-            images.append(image)
-            image_embs.append(
-                infer_model(dinov2, image).detach().cpu().numpy())
+                    dinov2 = load_feature_extractor(args, model=residency.acquire("dinov2"))
         
-        # reshaping
-        embeddings = np.array(image_embs)
-        embeddings = embeddings.reshape(len(image_embs), -1)
+                    # Compute initial distance from the loop-0 pool when resuming without a run state
+                    if loop_id != 0 and init_dist is None:
+                        loop0_embs = load_all_img_embeddings(loop0_pool_dir, dinov2, cache=emb_cache)
+                        init_dist = pool_distance(loop0_embs, **distance_kwargs)
+                        del loop0_embs
+                        log.info(f"Initial distance: {init_dist:.4f}")
+                        run_state.update(init_dist=init_dist)
         
-        # Compute initial distance at the first running loop
-        if loop_id == start_from:
-            if start_from == 0:
-                init_dist = np.mean(cdist(embeddings, embeddings, 'euclidean'))
-            else:
-                loop0_embs = load_all_img_embeddings(loop0_pool_dir, dinov2)
-                loop0_embs = np.array(loop0_embs).reshape(len(image_embs), -1)
-                init_dist = np.mean(cdist(loop0_embs, loop0_embs, 'euclidean'))
-                del loop0_embs
-            log.info(f"Initial distance: {init_dist:.4f}")
-                
-        # clean up the GPU consumption after inference
-        del pipe
-        del dinov2
-        torch.cuda.empty_cache()
+                    # the convergence is tested while the pool is generated, so that the generation can stop
+                    # as soon as the pool surely converged
+                    convergence_test = None
+                    if loop_id != 0 and getattr(args, "early_stop", True):
+                        convergence_test = SequentialConvergenceTest(init_dist * args.convergence_scale,
+                                                                     args.num_of_generated_img,
+                                                                     confidence=getattr(args, "early_stop_confidence", 0.99),
+                                                                     min_samples=getattr(args, "early_stop_min_images", 64))
+        
+                    # generate new images, embed and save them concurrently
+                    # the generated images could be loaded from local backup folder if it exists already,
+                    # the missing ones are rendered in batches, each image with its own seeded generator
+                    if queue is None:
+                        img_paths, embeddings = generate_and_embed_pool(
+                            pipe, dinov2, args, pool_dir, loop_id, loop_num, batch_size=gen_batch_size, cache=emb_cache,
+                            writer=writer, convergence_test=convergence_test, quality=quality,
+                            latents_dir=None if quality is not None else latents_dir_of(args, pool_dir))
+                    else:
+                        img_paths, embeddings = collect_pool_job(queue, dinov2, args, pool_dir, loop_id, job_name, missing,
+                                                                 cache=emb_cache)
         
-        # evaluate convergence
-        if loop_id != 0:
-            pairwise_distances = np.mean(cdist(embeddings, embeddings, 'euclidean'))
-            threshold = init_dist * args.convergence_scale
-            log.info((f"Current pairwise distance: {pairwise_distances:.4f}; "
-                      f"Target threshold: {threshold:.4f} ({init_dist:.4f}x{args.convergence_scale})"))
-            if pairwise_distances < threshold:
-                log.info(f"Converge at {loop_id}. Final model saved at {prev_output_dir}")
-                return prev_output_dir
+                    # Compute initial distance at the first loop
+                    if loop_id == 0:
+                        init_dist = pool_distance(embeddings, **distance_kwargs)
+                        log.info(f"Initial distance: {init_dist:.4f}")
+                        run_state.update(init_dist=init_dist)
                 
-        # set up the training data directory, overwrite and recreate
-        # the most cohesive cluster will be copied to the directory for training
-        args.train_data_dir_per_loop = os.path.join(train_data_dir_base, args.character_name, str(loop_id))
-        if os.path.exists(args.train_data_dir_per_loop):
-            shutil.rmtree(args.train_data_dir_per_loop)
-        os.makedirs(args.train_data_dir_per_loop)
+                    # free the device for training, the models wait in CPU memory for the next loop
+                    if pipe is not None:
+                        del pipe
+                        residency.release(sdxl_key)
+                    del dinov2
+                    residency.release("dinov2")
+                    residency.offload_all()
+                    residency.report(prefix=f"[{loop_id}/{loop_num-1}] ")
         
-        # clustering
-        centers, labels, elements, images = kmeans_clustering(args, embeddings, images = images)
+                    # evaluate convergence
+                    pairwise_distances = init_dist
+                    if loop_id != 0:
+                        if convergence_test is not None and (convergence_test.decision == "converged"
+                                                             or convergence_test.num_samples == len(embeddings)):
+                            # the pool was not generated to the end, use the streaming estimate,
+                            # or the test went through the whole pool, and its estimate is the exact distance
+                            pairwise_distances = convergence_test.estimate()
+                        else:
+                            pairwise_distances = pool_distance(embeddings, **distance_kwargs)
+                        threshold = init_dist * args.convergence_scale
+                        log.info((f"Current pairwise distance: {pairwise_distances:.4f}; "
+                                  f"Target threshold: {threshold:.4f} ({init_dist:.4f}x{args.convergence_scale})"))
+                        if pairwise_distances < threshold:
+                            log.info(f"Converge at {loop_id}. Final model saved at {prev_output_dir}")
+                            run_state.complete(loop_id, "generate", pairwise_distance=float(pairwise_distances))
+                            run_state.update(final_dir=prev_output_dir)
+                            return prev_output_dir
+                    run_state.complete(loop_id, "generate", pairwise_distance=float(pairwise_distances))
+                    yield "generate"
+                
+                # set up the training data directory, overwrite and recreate
+                # the most cohesive cluster will be copied to the directory for training
+                if os.path.exists(args.train_data_dir_per_loop):
+                    shutil.rmtree(args.train_data_dir_per_loop)
+                os.makedirs(args.train_data_dir_per_loop)
         
-        # visualize
-        if vis:
-            kmeans_2D_visualize(args, centers, elements, labels, loop_id)
+                # clustering
+                centers, labels, elements, indices = kmeans_clustering(args, embeddings)
         
-        # evaluate
-        center_norms = np.linalg.norm(centers[labels] - elements, axis=-1, keepdims=True) # each data point subtract its coresponding center
-        cohesions = np.zeros(len(np.unique(labels)))
-        for label_id in range(len(np.unique(labels))):
-            cohesions[label_id] = sum(center_norms[labels == label_id]) / sum(labels == label_id)
+                # visualize
+                if vis:
+                    kmeans_2D_visualize(args, centers, elements, labels, loop_id,
+                                        background=getattr(args, "vis_background", True))
         
-        # find the most cohesive cluster, and save the corresponding sample
-        min_cohesion_label = np.argmin(cohesions)
-        idx = np.where(labels == min_cohesion_label)[0]
-        for sample_id, sample in enumerate(images):
-            if sample_id in idx:
-                sample.save(os.path.join(args.train_data_dir_per_loop, f"{sample_id}.png"))
+                # find the most cohesive cluster, and materialize the corresponding pool images as training set
+                selected_indices = most_cohesive_cluster(centers, labels, elements, indices)
+                selected_paths = [img_paths[pool_idx] for pool_idx in selected_indices]
+                if quality is not None:
+                    # only the selected seeds are rendered again, at full quality, for the training
+                    selected_paths = render_full_quality(args, loop_id, selected_indices, adapters, residency, sdxl_key,
+                                                         queue=queue, batch_size=gen_batch_size, writer=writer)
+                materialize_training_set(selected_paths, args.train_data_dir_per_loop,
+                                         mode=getattr(args, "train_data_mode", "hardlink"), writer=writer)
+                writer.flush()
+                run_state.complete(loop_id, "cluster", selected_indices=[int(i) for i in selected_indices])
+                yield "cluster"
         
-        # train and save the models according to each loop's folder, and end the loop
-        train_pipeline(args, loop_id, loop_num)
+            # train and save the models according to each loop's folder, and end the loop
+            train_pipeline(args, loop_id, loop_num)
+            run_state.complete(loop_id, "train", checkpoint_dir=latest_checkpoint(args.output_dir_per_loop))
         
-        log.info(f"[{loop_id}/{loop_num-1}] Finish.")
+            log.info(f"[{loop_id}/{loop_num-1}] Finish.")
+            yield "train"
+    finally:
+        writer.close()
+        if own_queue:
+            queue.close()
+
 
+def latest_checkpoint(output_dir):
+    """
+    return: the checkpoint directory of the last training step in `output_dir`, None if there is none
+    """
+    ckpt_dirs = [d for d in Path(output_dir).glob("checkpoint-*") if d.name.split("-")[-1].isdigit()]
+    if not ckpt_dirs:
+        return None
+    return str(max(ckpt_dirs, key=lambda d: int(d.name.split("-")[-1])))
 
-def load_all_img_embeddings(dir, feat_extractor, img_file_suffix='.png'):
-    img_embs = []
+
+def load_all_img_embeddings(dir, feat_extractor, img_file_suffix='.png', cache=None):
     dir = Path(dir)
-    for child in dir.iterdir():
-        if child.with_suffix(img_file_suffix):
-            img = Image.open(child).convert('RGB')
-            emb = infer_model(feat_extractor, img).detach().cpu().numpy()
-            img_embs.append(emb)
+    img_paths = sorted(str(child) for child in dir.iterdir() if child.suffix == img_file_suffix)
+    img_embs = embed_images(feat_extractor, img_paths, cache=cache, cache_name=dir.name)
     log.info(f"Loaded {len(img_embs)} embeddings from '{dir}'.")
     return img_embs
-        
 
-def kmeans_clustering(args, data_points, images = None):
-    kmeans = KMeans(n_clusters=args.kmeans_center, init='k-means++', random_state=42)
-    kmeans.fit(data_points)
-    labels = kmeans.labels_
 
-    unique, counts = np.unique(labels, return_counts=True)
-    cluster_counts = dict(zip(unique, counts))
+def load_pool_embeddings(args, img_paths, residency, cache=None, cache_name=None):
+    """
+    embed the images of a pool generated before, from the embedding cache,
+    dinov2 is only acquired from `residency` if some images are missing from the cache
+    return: image paths, and embeddings in numpy of shape (N, D), both in index order
+    """
+    if cache is not None:
+        _, img_embs = cache.lookup(img_paths)
+        if all(emb is not None for emb in img_embs):
+            log.info(f"Embedding cache: {len(img_paths)} hit, 0 missed.")
+            return img_paths, np.stack(img_embs).astype(np.float32)
+    dinov2 = load_feature_extractor(args, model=residency.acquire("dinov2"))
+    embeddings = embed_images(dinov2, img_paths, cache=cache, cache_name=cache_name)
+    del dinov2
+    residency.release("dinov2")
+    residency.offload_all()
+    return img_paths, embeddings
 
-    selected_clusters = [cluster for cluster, count in cluster_counts.items() if count > args.dmin_c]
-    selected_centers = kmeans.cluster_centers_[selected_clusters]
-    selected_labels = []
+
+def generate_and_embed_pool(pipe, feat_extractor, args, pool_dir, loop_id, loop_num, batch_size=None, cache=None,
+                            writer=None, convergence_test=None, quality=None, latents_dir=None):
+    """
+    generate (or load) the pool images of a loop, while an embedding stage and the background
+    image writer consume them concurrently through bounded queues,
+    the generation stops early once the optional convergence test decides that the pool converged,
+    `quality` overrides the rendering settings (see `draft_quality`),
+    the latents of the rendered images are saved to `latents_dir` if given
+    return: image paths, and embeddings in numpy of shape (N, D), both in index order
+    """
+    img_paths, img_embs = [], []
+    num_missed = 0
+
+    def _embed(items):
+        nonlocal num_missed
+        # the loaded images may be in the cache already, the generated ones are always new
+        cached = [None] * len(items)
+        loaded = [i for i, (_, _, is_new) in enumerate(items) if not is_new]
+        if cache is not None and loaded:
+            _, hits = cache.lookup([img_paths[items[i][0]] for i in loaded])
+            for i, emb in zip(loaded, hits):
+                cached[i] = emb
+        missing = [i for i, emb in enumerate(cached) if emb is None]
+        if missing:
+            for i, emb in zip(missing, feat_extractor([items[i][1] for i in missing])):
+                cached[i] = emb
+        num_missed += len(missing)
+        img_embs.extend(cached)
+        if convergence_test is not None:
+            for emb in cached:
+                convergence_test.update(emb)
+
+    queue_size = getattr(args, "pipeline_queue_size", 16)
+    # the images are embedded as soon as they are rendered, not once a full embedding batch is queued,
+    # so that the convergence test stops the generation without a batch of images in delay
+    embed_stage = PipelineStage("embed", _embed, maxsize=queue_size, batch_size=feat_extractor.batch_size,
+                                flush_timeout=0.05)
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter(max_in_flight=queue_size)
+    start = time.perf_counter()
+    try:
+        # the images already in the pool are passed by path, and only decoded on an embedding cache miss
+        for n_img, image, is_new in iter_pool_images(pipe, args, pool_dir, loop_id, batch_size=batch_size, lazy=True,
+                                                     latents_dir=latents_dir, **(quality or {})):
+            if convergence_test is not None and convergence_test.decision == "converged":
+                low, high = convergence_test.bounds()
+                log.info((f"Early stop: converged after {convergence_test.decided_at} images "
+                          f"(mean distance in [{low:.4f}, {high:.4f}] < {convergence_test.threshold:.4f}), "
+                          f"saved {args.num_of_generated_img - len(img_paths)} of {args.num_of_generated_img} images."))
+                break
+            log.info((f"LP {loop_id:4>}/{loop_num-1:4<} "
+                      f"{'generated' if is_new else 'loaded'} IMG {n_img:4>}/{args.num_of_generated_img - 1:4<}"))
+            img_paths.append(os.path.join(pool_dir, f"{n_img}.png"))
+            if is_new:
+                writer.save(image, img_paths[-1])
+            embed_stage.put((len(img_paths) - 1, image, is_new))
+    finally:
+        embed_stage.join()
+        # the cache hashes the written files, and the next phases read them
+        if own_writer:
+            writer.close()
+        else:
+            writer.flush()
+    wall = time.perf_counter() - start
+    blocked = embed_stage.blocked_time + writer.blocked_time
+    log.info(f"Pool pipeline done in {wall:.1f}s: stage 'generate': busy {wall - blocked:.1f}s, blocked {blocked:.1f}s")
+    log.info(f"Pool pipeline {embed_stage.summary()}")
+    if convergence_test is not None and convergence_test.decision == "not_converged":
+        # the clustering needs the whole pool, the test only saves computing its distance again
+        log.info(f"Surely not converged after {convergence_test.decided_at} images, the pool was generated to the end.")
+    log.info(f"Pool pipeline {writer.summary()}")
+
+    embeddings = np.stack(img_embs).astype(np.float32) if img_embs else np.zeros((0, 0), dtype=np.float32)
+    if cache is not None:
+        log.info(f"Embedding cache: {len(img_paths) - num_missed} hit, {num_missed} missed.")
+        if num_missed:
+            # a group per pool directory, the draft and full quality pools of a loop never replace each other
+            cache.save(os.path.basename(pool_dir), img_paths, embeddings)
+    return img_paths, embeddings
+
+
+def draft_quality(args):
+    """
+    rendering settings of the draft pools, enabled by `draft_pool`, with `draft_infer_steps` steps and a side of `draft_resolution`
+    (the full resolution if unset, the selected images are then rendered again from the same noise)
+    return: dict of `infer_steps` and `resolution`, None for full quality pools
+    """
+    if not getattr(args, "draft_pool", False):
+        return None
+    return dict(infer_steps=getattr(args, "draft_infer_steps", None), resolution=getattr(args, "draft_resolution", None))
+
+
+def pool_dir_of(args, loop_id, quality=None):
+    """
+    return: pool directory of a loop, a draft pool is named after its rendering settings
+    """
+    pool_dir = f"{args.backup_data_dir_root}/{args.character_name}/{loop_id}"
+    if quality is None:
+        return pool_dir
+    return f"{pool_dir}_draft_s{quality['infer_steps'] or args.infer_steps}_r{quality['resolution'] or 'default'}"
+
+
+def latents_dir_of(args, pool_dir):
+    """
+    return: directory of the latents rendered along the pool images, handed over to the training with `latent_handoff`,
+    None without
+    """
+    if not getattr(args, "latent_handoff", False):
+        return None
+    return os.path.join(pool_dir, "latents")
+
+
+def render_full_quality(args, loop_id, indices, adapters, residency, sdxl_key, queue=None, batch_size=None, writer=None):
+    """
+    render the pool images `indices` of a loop again at full quality, with the seeds of the draft pool,
+    into the full quality pool directory, locally or by the pool workers
+    return: paths of the full quality images
+    """
+    pool_dir = pool_dir_of(args, loop_id)
+    os.makedirs(pool_dir, exist_ok=True)
+    indices = [int(i) for i in indices]
+    if getattr(args, "draft_resolution", None) is not None:
+        # the noise of a seed depends on the latent size, only the denoising steps keep the images comparable
+        log.warning((f"The draft pool was rendered at resolution {args.draft_resolution}, the same seeds at full "
+                     f"resolution draw other noise: the re-rendered images are not the clustered ones."))
+    start = time.perf_counter()
+    if queue is not None:
+        job_name, missing = publish_pool_job(queue, args, pool_dir, loop_id, adapters=adapters, indices=indices,
+                                             job_suffix="_full")
+        if missing:
+            queue.wait(job_name, poll_interval=getattr(args, "queue_poll_interval", 5.0))
+    else:
+        pipe = residency.acquire(sdxl_key)
+        # another character may have swapped its own adapters in meanwhile
+        swap_loop_adapters(pipe, args, **adapters)
+        for img_id, image, is_new in iter_pool_images(pipe, args, pool_dir, loop_id, batch_size=batch_size,
+                                                      indices=indices, lazy=True, latents_dir=latents_dir_of(args, pool_dir)):
+            if is_new:
+                writer.save(image, os.path.join(pool_dir, f"{img_id}.png"))
+        del pipe
+        residency.release(sdxl_key)
+        residency.offload_all()
+        writer.flush()
+    log.info(f"Rendered {len(indices)} selected images at full quality in {time.perf_counter() - start:.1f}s.")
+    return [os.path.join(pool_dir, f"{img_id}.png") for img_id in indices]
+
+
+def publish_pool_job(queue, args, pool_dir, loop_id, adapters=None, indices=None, quality=None, job_suffix=""):
+    """
+    publish the images missing from the pool of a loop (or from its `indices`) to the shared work queue,
+    with the adapters of the loop and the rendering settings `quality` (see `draft_quality`)
+    return: job name, and ids of the published images
+    """
+    base_seed = getattr(args, "seed", 0) or 0
+    quality = quality or {}
+    if indices is None:
+        indices = range(args.num_of_generated_img)
+    missing = [img_id for img_id in indices if not os.path.exists(os.path.join(pool_dir, f"{img_id}.png"))]
+    job_name = f"{args.character_name}_loop_{loop_id}{job_suffix}"
+    if missing:
+        # the seeds are the ones of the local generation, so both render the same pool
+        spec = dict(loop_id=loop_id, pool_dir=os.path.abspath(pool_dir), prompt=args.inference_prompt,
+                    infer_steps=quality.get("infer_steps") or args.infer_steps, resolution=quality.get("resolution"),
+                    placeholder_token=args.placeholder_token, num_vectors=args.num_vectors, **(adapters or {}))
+        items = [dict(key=str(img_id), img_id=img_id, seed=derive_seed(loop_id, img_id, base_seed)) for img_id in missing]
+        queue.publish(job_name, spec, items)
+    return job_name, missing
+
+
+def collect_pool_job(queue, feat_extractor, args, pool_dir, loop_id, job_name, missing, cache=None):
+    """
+    wait for the workers to render, save and embed the published images, the images already in the pool are embedded here
+    return: image paths, and embeddings in numpy of shape (N, D), both in index order
+    """
+    img_paths = [os.path.join(pool_dir, f"{img_id}.png") for img_id in range(args.num_of_generated_img)]
+    img_embs = [None] * len(img_paths)
+    if missing:
+        results = queue.wait(job_name, poll_interval=getattr(args, "queue_poll_interval", 5.0))
+        for img_id, emb in zip(missing, results):
+            img_embs[img_id] = emb
+    
+    # the images already in the pool, from the cache if possible
+    loaded = [img_id for img_id, emb in enumerate(img_embs) if emb is None]
+    if loaded:
+        for img_id, emb in zip(loaded, embed_images(feat_extractor, [img_paths[i] for i in loaded], cache=cache,
+                                                    cache_name=os.path.basename(pool_dir))):
+            img_embs[img_id] = emb
+    log.info(f"Pool of loop {loop_id}: {len(missing)} images rendered by the workers, {len(loaded)} loaded.")
+    
+    embeddings = np.stack(img_embs).astype(np.float32)
+    if cache is not None and missing:
+        cache.save(os.path.basename(pool_dir), img_paths, embeddings)
+    return img_paths, embeddings
+
+
+def run_pool_worker(args, queue_dir):
+    """
+    render, save and embed the pool images published to the shared work queue, until the coordinator closes it,
+    one worker per GPU (picked with CUDA_VISIBLE_DEVICES), on any host sharing the queue and pool directories,
+    a worker serves every character whose base model is the one of its config
+    """
+    queue = WorkQueue(queue_dir, lease_seconds=getattr(args, "queue_lease_seconds", 600))
+    pipe = load_base_pipeline(args)
+    feat_extractor = load_feature_extractor(args)
+    batch_size = AdaptiveBatchSize(getattr(args, "gen_batch_size", 1),
+                                   getattr(args, "gen_max_batch_size", 2 * getattr(args, "gen_batch_size", 1)))
+    
+    def _prepare(spec):
+        # the jobs of every character sharing the queue, with their own placeholder tokens, on the base of the worker
+        loop_args = argparse.Namespace(placeholder_token=spec["placeholder_token"], num_vectors=spec["num_vectors"],
+                                       pretrained_model_name_or_path=args.pretrained_model_name_or_path,
+                                       pretrained_vae_model_name_or_path=getattr(args, "pretrained_vae_model_name_or_path", None))
+        swap_loop_adapters(pipe, loop_args, lora_path=spec.get("lora_path"), embeds_dir=spec.get("embeds_dir"))
     
-    selected_labels = [label for label in labels if label in selected_clusters]
-    selected_labels = make_continuous(selected_labels)
-    selected_labels = np.array(selected_labels)
+    def _process(spec, items):
+        pipe_kwargs = {} if spec.get("resolution") is None else dict(height=spec["resolution"], width=spec["resolution"])
+        images = []
+        while len(images) < len(items):
+            batch = items[len(images):len(images) + batch_size.size]
+            try:
+                images += generate_images_batched(pipe, spec["prompt"], spec["infer_steps"], [item["seed"] for item in batch],
+                                                  **pipe_kwargs)
+            except Exception as err:
+                if not is_oom_error(err):
+                    raise
+                torch.cuda.empty_cache()
+                if not batch_size.shrink():
+                    raise
+                continue
+            batch_size.success()
+        # the image is in the pool before its embedding marks it as done
+        for item, image in zip(items, images):
+            save_image_atomic(image, os.path.join(spec["pool_dir"], f"{item['img_id']}.png"))
+        return feat_extractor(images)
     
-    selected_elements = np.array([data_points[i] for i, label in enumerate(labels) if label in selected_clusters])
-    if images:
-        selected_images = [images[i] for i, label in enumerate(labels) if label in selected_clusters]
+    run_worker(queue, _prepare, _process, batch_size=batch_size,
+               poll_interval=getattr(args, "queue_poll_interval", 5.0))
+
+
+def embed_images(feat_extractor, img_paths, images=None, cache=None, cache_name=None):
+    """
+    embed the image files with the feature extractor, reusing the cached embeddings if a cache is given
+    return: embeddings, in numpy of shape (N, D)
+    """
+    if not img_paths:
+        return np.zeros((0, 0), dtype=np.float32)
+    if cache is not None:
+        digests, img_embs = cache.lookup(img_paths)
     else:
-        selected_images = None
+        digests, img_embs = None, [None] * len(img_paths)
+    missing = [i for i, emb in enumerate(img_embs) if emb is None]
+    if missing:
+        # decoded images are reused when given, otherwise the extractor reads the files
+        missing_embs = feat_extractor([images[i] if images is not None else img_paths[i] for i in missing])
+        for i, emb in zip(missing, missing_embs):
+            img_embs[i] = emb
+    img_embs = np.stack(img_embs).astype(np.float32)
+    
+    if cache is not None:
+        log.info(f"Embedding cache: {len(img_paths) - len(missing)} hit, {len(missing)} missed.")
+        if missing:
+            cache.save(cache_name, img_paths, img_embs, digests)
+    return img_embs
+        
 
-    return selected_centers, selected_labels, selected_elements, selected_images
+def kmeans_clustering(args, data_points):
+    """
+    cluster the embeddings, and keep the clusters with more than `dmin_c` elements
+    return: centers, continuous labels and elements of the kept clusters, and the indices of the elements in `data_points`
+    """
+    # backend and restarts from `kmeans_backend`, `kmeans_n_init` and `kmeans_device`
+    cluster_centers, labels, inertia = fit_kmeans(data_points, args.kmeans_center,
+                                                  backend=getattr(args, "kmeans_backend", "sklearn"),
+                                                  n_init=getattr(args, "kmeans_n_init", 10),
+                                                  seed=42,
+                                                  device=getattr(args, "kmeans_device", "cpu"))
+    log.info(f"K-means inertia: {inertia:.4f}")
+
+    counts = np.bincount(labels, minlength=len(cluster_centers))
+    selected_clusters = np.flatnonzero(counts > args.dmin_c)
+    selected_indices = np.flatnonzero(counts[labels] > args.dmin_c)
+
+    # relabel the kept clusters as 0..n-1, in their original order
+    continuous_labels = np.full(len(cluster_centers), -1)
+    continuous_labels[selected_clusters] = np.arange(len(selected_clusters))
 
+    selected_centers = cluster_centers[selected_clusters]
+    selected_labels = continuous_labels[labels[selected_indices]]
+    selected_elements = np.asarray(data_points)[selected_indices]
+    return selected_centers, selected_labels, selected_elements, selected_indices
 
-def make_continuous(lst):
-    unique_elements = sorted(set(lst))
-    mapping = {elem: i for i, elem in enumerate(unique_elements)}
-    return [mapping[elem] for elem in lst]
 
+def most_cohesive_cluster(centers, labels, elements, indices):
+    """
+    find the cluster with the lowest mean distance of its elements to its center
+    return: indices of its elements
+    """
+    if len(centers) == 0:
+        raise ValueError("No cluster is larger than `dmin_c`, nothing to train on.")
+    center_norms = np.linalg.norm(centers[labels] - elements, axis=-1) # each data point subtract its coresponding center
+    cohesions = np.bincount(labels, weights=center_norms, minlength=len(centers)) / np.bincount(labels, minlength=len(centers))
+    return indices[labels == np.argmin(cohesions)]
 
-def kmeans_2D_visualize(args, centers, data, labels, loop_num):
+
+def kmeans_2D_visualize(args, centers, data, labels, loop_num, background=True):
+    """
+    plot the 2D projection of the clusters (`vis_projection`: auto, tsne, bhtsne or pca),
+    in a detached process by default, so that it never delays the training
+    """
     img_filename = f"{args.character_name}_KMeans_res_Loop_{loop_num}.png"
     output_dir = args.kmeans_result_dir if hasattr(args, "kmeans_result_dir") else "./kmeans_results"
     os.makedirs(output_dir, exist_ok=True)
     img_path = os.path.join(output_dir, img_filename)
+    method = getattr(args, "vis_projection", "auto")
+    title = f"{args.character_name} loop {loop_num}"
     
-    # visualize 2D t-SNE results
-    plt.figure(figsize=(20, 16))
-    tsne = TSNE(n_components=2, random_state=42, perplexity=len(data) - 1)
-    embeddings_2d = tsne.fit_transform(data)
-    
-    for i in range(args.kmeans_center):
-        cluster_points = np.array(embeddings_2d[labels==i])
-        plt.scatter(cluster_points[:, 0], cluster_points[:, 1], label=f"Cluster {i + 1}", s=100)
-    plt.savefig(img_path)
+    if background:
+        launch_plot_clusters(data, labels, img_path, method=method, title=title)
+    else:
+        plot_clusters(data, labels, img_path, method=method, title=title)
     
         
 def compare_features(image_features, cluster_centroid):
@@ -247,6 +677,24 @@ def compare_features(image_features, cluster_centroid):
     return distance
 
 
+def materialize_training_set(img_paths, data_dir, mode="hardlink", writer=None):
+    """
+    make the pool images available in the training directory as hard links, symlinks or copies,
+    or only list them in a manifest read by the training dataset (`mode='manifest'`)
+    """
+    if mode == "manifest":
+        write_manifest(data_dir, img_paths)
+        return
+    if mode not in MATERIALIZE_MODES:
+        raise ValueError(f'Invalid training data mode: "{mode}", choose from {MATERIALIZE_MODES}')
+    for img_path in img_paths:
+        dst = os.path.join(data_dir, os.path.basename(img_path))
+        if writer is not None:
+            writer.copy(img_path, dst, mode=mode)
+        else:
+            link_or_copy(img_path, dst, mode=mode)
+
+
 def prepare_init_images(source_path, target_root_path):
     img_out_base = target_root_path
     init_loop_img_fdr = os.path.join(img_out_base, "0")
@@ -260,57 +708,155 @@ def prepare_init_images(source_path, target_root_path):
         log.info(f"Copied {src_path} to {dest_path}")
 
 
-def load_trained_pipeline(model_path = None, load_lora=True, lora_path=None):
+def make_residency(args):
+    """
+    owner of the models kept across loops, on the device, within `residency_budget_gb`
+    """
+    budget_gb = getattr(args, "residency_budget_gb", None)
+    return ModelResidency("cuda", budget_bytes=None if budget_gb is None else int(budget_gb * 2**30))
+
+
+def make_pool_queue(args):
+    """
+    the work queue of the pool generation in `pool_queue_dir`, reopened for the workers
+    """
+    queue = WorkQueue(args.pool_queue_dir, lease_seconds=getattr(args, "queue_lease_seconds", 600))
+    queue.open()
+    return queue
+
+
+def base_pipeline_key(args):
+    """
+    identity of the frozen base pipeline of a config, the characters with the same one share it
+    """
+    weight_dtype, _ = base_weight_dtypes(args)
+    return (f"sdxl:{args.pretrained_model_name_or_path}:{getattr(args, 'pretrained_vae_model_name_or_path', None)}"
+            f":{weight_dtype}")
+
+
+def schedule_characters(configs, policy="round_robin", start_from=None):
     """
-    load the diffusion pipeline according to the trained model
+    run the training loops of several characters in one process, interleaving their phases,
+    dinov2 and the base pipelines are loaded once for all of them, only the adapters are per character
+    return: the final model directory of every character, None if not converged
     """
-    if model_path is not None:
-        # TODO: long warning for lora
+    all_args = [config2args(config) for config in configs]
+    # the device budget and the pool queue are the ones of the first config
+    residency = make_residency(all_args[0])
+    queue = make_pool_queue(all_args[0]) if getattr(all_args[0], "pool_queue_dir", None) is not None else None
+    
+    scheduler = PhaseScheduler(policy=policy)
+    for args in all_args:
+        scheduler.add(args.character_name, train_loop_phases(args, args.max_loop, start_from=start_from,
+                                                             residency=residency, queue=queue))
+    try:
+        return scheduler.run()
+    finally:
+        if queue is not None:
+            queue.close()
+
+
+def load_trained_pipeline(args, model_path=None, lora_path=None):
+    """
+    load the diffusion pipeline of a trained loop: the base pipeline of `args` with the adapters of `model_path`
+    (lora weights, learned embeddings and placeholder tokens, see `save_adapter_manifest`),
+    the lora weights are taken from `lora_path` (e.g. a checkpoint) if given,
+    a loop saved as a full pipeline (without adapter manifest) is loaded as is
+    """
+    if model_path is None:
+        return load_base_pipeline(args)
+    if load_adapter_manifest(model_path) is None:
         pipe = DiffusionPipeline.from_pretrained(model_path, torch_dtype=torch.float16)
-        if load_lora:
-            pipe.load_lora_weights(lora_path)
-    else:
-        pipe = DiffusionPipeline.from_pretrained("stabilityai/stable-diffusion-xl-base-1.0")
-    pipe.to("cuda")
+        pipe.to("cuda")
+        pipe.load_lora_weights(lora_path or model_path)
+        return pipe
+    pipe = load_base_pipeline(args)
+    swap_loop_adapters(pipe, args, lora_path=lora_path or model_path, embeds_dir=model_path)
     return pipe
 
 
-def infer_model(model, image):
-    transform = T.Compose([
-        T.Resize((518, 518)),
-        T.ToTensor(),
-        T.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
-    ])
-    image = transform(image).unsqueeze(0).cuda()
-    cls_token = model(image, is_training=False)
-    return cls_token
+def load_base_pipeline(args):
+    """
+    load the frozen base SDXL pipeline in the dtypes of the training (e.g. bfloat16), with the VAE used by the training,
+    its models are the ones the training of this process uses (see `base_pipeline`), a single copy in memory
+    """
+    pipe = base_pipeline(args)
+    pipe.to("cuda")
+    return pipe
 
 
-def generate_images(pipe: StableDiffusionXLPipeline, prompt: str, infer_steps, guidance_scale=7.5):
+def swap_loop_adapters(pipe, args, lora_path=None, embeds_dir=None):
     """
-    use the given DiffusionPipeline, generate N images for the same character
-    return: image, in PIL
+    replace the LoRA weights and the learned placeholder embeddings of the resident pipeline by the ones of a loop,
+    the base pipeline is restored when no path is given,
+    the tokens and file names are read from the adapter manifest of `embeds_dir` if it has one,
+    which must have been trained on the same base model
     """
-    image = pipe(prompt, num_inference_steps=infer_steps, guidance_scale=guidance_scale).images[0]
-    return image
+    # a training loop ran on the models shared with the base pipeline meanwhile
+    reset_base_pipeline(pipe)
+    pipe.unload_lora_weights()
+    if lora_path is not None:
+        pipe.load_lora_weights(lora_path)
+    if embeds_dir is None:
+        return
+
+    fingerprint = base_fingerprint(args.pretrained_model_name_or_path, getattr(args, "pretrained_vae_model_name_or_path", None),
+                                   pipe.unet.config, pipe.vae.config)
+    manifest = load_adapter_manifest(embeds_dir, fingerprint=fingerprint) or {}
+    placeholder_token = manifest.get("placeholder_token", args.placeholder_token)
+    placeholder_tokens = manifest.get("placeholder_tokens") or (
+        [args.placeholder_token] + [f"{args.placeholder_token}_{i}" for i in range(1, args.num_vectors)])
+    weight_names = manifest.get("embeds") or ("learned_embeds_one.safetensors", "learned_embeds_two.safetensors")
+    for tokenizer, text_encoder, weight_name in ((pipe.tokenizer, pipe.text_encoder, weight_names[0]),
+                                                 (pipe.tokenizer_2, pipe.text_encoder_2, weight_names[1])):
+        learned_embeds = safetensors.torch.load_file(os.path.join(embeds_dir, weight_name))[placeholder_token]
+        tokenizer.add_tokens(placeholder_tokens)
+        # the vocabulary of the text encoder may have been reset since the tokens were added
+        if text_encoder.get_input_embeddings().num_embeddings != len(tokenizer):
+            text_encoder.resize_token_embeddings(len(tokenizer))
+        token_ids = tokenizer.convert_tokens_to_ids(placeholder_tokens)
+        embeddings = text_encoder.get_input_embeddings().weight
+        with torch.no_grad():
+            embeddings[token_ids] = learned_embeds.to(embeddings.device, dtype=embeddings.dtype)
 
 
 def load_dinov2():
-    dinov2_vitl14 = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitl14').cuda()
+    dinov2_vitl14 = torch.hub.load(DINOV2_REPO, DINOV2_MODEL).cuda()
     dinov2_vitl14.eval()
     return dinov2_vitl14
 
 
+def load_feature_extractor(args, model=None):
+    """
+    wrap dinov2 (loaded if not given) into a batched feature extractor, configured by `embed_batch_size` and `embed_num_workers`
+    """
+    return FeatureExtractor(load_dinov2() if model is None else model,
+                            input_size=DINOV2_INPUT_SIZE,
+                            batch_size=getattr(args, "embed_batch_size", 16),
+                            num_workers=getattr(args, "embed_num_workers", 4))
+
+
 if __name__ == "__main__":
     cmd_parser = argparse.ArgumentParser(description="Process running command.")
-    cmd_parser.add_argument('-c', '--config_file', type=str) 
-    cmd_parser.add_argument('-l', '--beginning_loop_id', type=int, default=0) 
+    cmd_parser.add_argument('-c', '--config_file', type=str, nargs='+', help="several configs are scheduled together") 
+    cmd_parser.add_argument('-l', '--beginning_loop_id', type=int, default=None, help="resume from the run state if not given") 
+    cmd_parser.add_argument('-w', '--worker', action='store_true', help="render pools from `pool_queue_dir` instead") 
+    cmd_parser.add_argument('-p', '--policy', type=str, default='round_robin', choices=SCHEDULING_POLICIES) 
     cmd_args = cmd_parser.parse_args()
     log.info(cmd_args)
     
-    args = config2args(cmd_args.config_file)
+    if len(cmd_args.config_file) > 1 and not cmd_args.worker:
+        schedule_characters(cmd_args.config_file, policy=cmd_args.policy, start_from=cmd_args.beginning_loop_id)
+        log.info(f"Log is dumped to {log.dump_path.absolute()}.")
+        exit()
+    
+    args = config2args(cmd_args.config_file[0])
     log.info(args)
     
+    if cmd_args.worker:
+        run_pool_worker(args, args.pool_queue_dir)
+        exit()
+    
     train_loop(args, args.max_loop, start_from=cmd_args.beginning_loop_id)
     
     log.info(f"Log is dumped to {log.dump_path.absolute()}.")
@@ -16,12 +16,14 @@
 """Fine-tuning script for Stable Diffusion XL for text2image with support for LoRA."""
 
 import argparse
+import copy
 import itertools
 import logging
 import math
 import os
 import random
 import shutil
+import time
 from pathlib import Path
 from typing import Dict
 from torch.utils.data import Dataset
@@ -53,7 +55,13 @@ from PIL import Image
 import PIL
 import safetensors
 
+from utils.adapters import base_fingerprint, save_adapter_manifest
+from utils.generation import generate_images_batched
+from utils.image_io import list_images
+from utils.image_store import ImageStore
+from utils.latent_cache import LatentCache, sample_latents
 from utils.logger import get_logger
+from utils.placeholder_embedding import PlaceholderEmbedding
 
 
 if version.parse(version.parse(PIL.__version__).base_version) >= version.parse("9.1.0"):
@@ -232,10 +240,16 @@ def parse_args(input_args=None):
         type=int,
         default=1,
         help=(
-            "Run fine-tuning validation every X epochs. The validation process consists of running the prompt"
+            "Run fine-tuning validation every X epochs, unless `validation_steps` is set. The validation process consists of running the prompt"
             " `args.validation_prompt` multiple times: `args.num_validation_images`."
         ),
     )
+    parser.add_argument(
+        "--validation_steps",
+        type=int,
+        default=None,
+        help="Run fine-tuning validation every X optimization steps, instead of every `validation_epochs` epochs.",
+    )
     parser.add_argument(
         "--max_train_samples",
         type=int,
@@ -397,7 +411,7 @@ def parse_args(input_args=None):
     parser.add_argument(
         "--save_as_full_pipeline",
         action="store_true",
-        help="Save the complete stable diffusion pipeline.",
+        help="Save the complete stable diffusion pipeline, besides the lora weights and learned embeddings of the loop.",
     )
     parser.add_argument("--hub_token", type=str, default=None, help="The token to use to push to the Model Hub.")
     parser.add_argument(
@@ -599,7 +613,8 @@ class TextualInversionDataset(Dataset):
                 transforms.Normalize([0.5], [0.5]),
             ]
         )
-        self.image_paths = [os.path.join(self.data_root, file_path) for file_path in os.listdir(self.data_root)]
+        # the images of the directory, or the pool images listed in its manifest
+        self.image_paths = list_images(self.data_root)
 
         self.num_images = len(self.image_paths)
         self._length = self.num_images
@@ -616,55 +631,99 @@ class TextualInversionDataset(Dataset):
         }[interpolation]
 
         self.templates = imagenet_style_templates_small if learnable_property == "style" else imagenet_templates_small
+        # every template with the placeholder tokenized once, by both tokenizers: (num_templates, max_length) ids
+        texts = [template.format(placeholder_token) for template in self.templates]
+        self.template_input_ids_one = tokenize_prompt(tokenizer_one, texts)
+        self.template_input_ids_two = tokenize_prompt(tokenizer_two, texts)
         self.flip_transform = transforms.RandomHorizontalFlip(p=self.flip_p)
+        # cached latent distributions of the images, see `LatentCache`
+        self.latent_cache = None
+        # decoded and resized images, see `ImageStore`
+        self.image_store = None
 
     def __len__(self):
         return self._length
 
-    def __getitem__(self, i):
-        example = {}
-        
-        # TODO: support various batch size
+    def _load_image(self, i):
         image = Image.open(self.image_paths[i % self.num_images])
-        
         if not image.mode == "RGB":
             image = image.convert("RGB")
-        example["original_sizes"] = (image.height, image.width)
+        return image
+
+    def _transform(self, image, crop_params=None, flip=False):
+        """
+        resize, crop (at `crop_params`, random if None) and flip a training image
+        return: pixel values, original size and crop top left
+        """
+        original_size = (image.height, image.width)
         image = self.train_resize(image)
         if self.args.center_crop:
             y1 = max(0, int(round((image.height - self.args.resolution) / 2.0)))
             x1 = max(0, int(round((image.width - self.args.resolution) / 2.0)))
             image = self.train_crop(image)
         else:
-            y1, x1, h, w = self.train_crop.get_params(image, (self.args.resolution, self.args.resolution))
+            y1, x1, h, w = crop_params or self.train_crop.get_params(image, (self.args.resolution, self.args.resolution))
             image = crop(image, y1, x1, h, w)
-        if self.args.random_flip and random.random() < 0.5:
-            # flip
+        if flip:
             x1 = image.width - x1
             image = self.train_flip(image)
-        crop_top_left = (y1, x1)
-        example["crop_top_lefts"] = crop_top_left
-        image = self.train_transforms(image)
-        example["pixel_values"] = image
-        
-        placeholder_string = self.placeholder_token
-        text = random.choice(self.templates).format(placeholder_string) # a rendering of {}
+        return self.train_transforms(image), original_size, (y1, x1)
+
+    def _crop_stored(self, i, flip=False):
+        """
+        crop and flip the stored image `i` as `_transform` does, without decoding or normalizing it,
+        the uint8 crop goes to the device, where it is normalized in the training step
+        return: uint8 pixel values, original size and crop top left
+        """
+        i = i % self.num_images
+        height, width, _ = self.image_store.image(i).shape
+        resolution = self.args.resolution
+        if self.args.center_crop:
+            y1 = max(0, int(round((height - resolution) / 2.0)))
+            x1 = max(0, int(round((width - resolution) / 2.0)))
+        else:
+            y1 = random.randint(0, height - resolution)
+            x1 = random.randint(0, width - resolution)
+        pixels = self.image_store.crop(i, y1, x1, resolution, resolution, flip=flip)
+        if flip:
+            x1 = resolution - x1
+        return pixels, self.image_store.original_size(i), (y1, x1)
+
+    def image_variants(self, i, num_crops=1):
+        """
+        every flip of the center crop, or of `num_crops` random crops, of the image `i`
+        return: list of (pixel values, original size, crop top left, flipped)
+        """
+        image = self._load_image(i)
+        crops = [None]
+        if not self.args.center_crop:
+            resized = self.train_resize(image)
+            crops = list(dict.fromkeys(self.train_crop.get_params(resized, (self.args.resolution, self.args.resolution))
+                                       for _ in range(num_crops)))
+        flips = (False, True) if self.args.random_flip else (False,)
+        return [(*self._transform(image, crop_params, flip), flip) for crop_params in crops for flip in flips]
+
+    def __getitem__(self, i):
+        example = {}
         
-        example["input_ids_one"] = self.tokenizer_one(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=self.tokenizer_one.model_max_length,
-            return_tensors="pt",
-        ).input_ids[0] # tokenize the whole sentence, e.g. a rendering of "placeholder"
+        if self.latent_cache is not None:
+            # a random variant of the image, already encoded
+            example["latent_params"], example["original_sizes"], example["crop_top_lefts"] = \
+                self.latent_cache.sample(i % self.num_images)
+        elif self.image_store is not None:
+            # normalized on the device, in the training step
+            flip = self.args.random_flip and random.random() < 0.5
+            example["pixel_values"], example["original_sizes"], example["crop_top_lefts"] = self._crop_stored(i, flip=flip)
+        else:
+            image = self._load_image(i)
+            flip = self.args.random_flip and random.random() < 0.5
+            example["pixel_values"], example["original_sizes"], example["crop_top_lefts"] = self._transform(image, flip=flip)
         
-        example["input_ids_two"] = self.tokenizer_two(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=self.tokenizer_two.model_max_length,
-            return_tensors="pt",
-        ).input_ids[0] # tokenize the whole sentence, e.g. a rendering of "placeholder"
+        # a rendering of {} with the placeholder, looked up in the tokenized templates
+        template_id = random.randrange(len(self.templates))
+        example["template_ids"] = template_id # index into the prompt embedding cache, see `precompute_prompt_embeds`
+        example["input_ids_one"] = self.template_input_ids_one[template_id]
+        example["input_ids_two"] = self.template_input_ids_two[template_id]
         
         # # default to score-sde preprocessing
         # img = np.array(image).astype(np.uint8)
@@ -690,6 +749,18 @@ class TextualInversionDataset(Dataset):
 
 
 
+def collate_fn(examples):
+    """
+    stack the examples of `TextualInversionDataset` into a batch,
+    the original sizes and crop top lefts of the samples into tensors of shape (B, 2)
+    """
+    batch = {}
+    for key in examples[0]:
+        values = [example[key] for example in examples]
+        batch[key] = torch.stack(values) if isinstance(values[0], torch.Tensor) else torch.tensor(values)
+    return batch
+
+
 def unet_attn_processors_state_dict(unet) -> Dict[str, torch.tensor]:
     """
     Returns:
@@ -747,6 +818,254 @@ def encode_prompt(text_encoders, tokenizers, prompt, text_input_ids_list=None):
     return prompt_embeds, pooled_prompt_embeds
 
 
+# outcome of `check_fast_tokenizers` per base model and placeholder tokens: None if the fast tokenizers agree,
+# otherwise the slow tokenizers with the placeholder tokens added
+_FAST_TOKENIZER_CHECKS = {}
+
+
+def check_fast_tokenizers(args, tokenizers, placeholder_tokens, templates):
+    """
+    compare the fast tokenizers, with the placeholder tokens added, to the slow ones:
+    the ids of the placeholder tokens and of every template must be identical,
+    the slow tokenizers are loaded and compared once per process for a model and placeholder tokens
+    return: the fast tokenizers if they agree, otherwise slow ones with the placeholder tokens added
+    """
+    key = (args.pretrained_model_name_or_path, args.revision, tuple(placeholder_tokens), tuple(templates))
+    if key not in _FAST_TOKENIZER_CHECKS:
+        placeholder_string = " ".join(placeholder_tokens)
+        texts = [placeholder_string] + [template.format(placeholder_string) for template in templates]
+        slow_tokenizers = []
+        for subfolder in ("tokenizer", "tokenizer_2"):
+            slow_tokenizer = AutoTokenizer.from_pretrained(
+                args.pretrained_model_name_or_path, subfolder=subfolder, revision=args.revision, use_fast=False)
+            slow_tokenizer.add_tokens(placeholder_tokens)
+            slow_tokenizers.append(slow_tokenizer)
+        _FAST_TOKENIZER_CHECKS[key] = None
+        for tokenizer, slow_tokenizer in zip(tokenizers, slow_tokenizers):
+            if (tokenizer.convert_tokens_to_ids(placeholder_tokens) != slow_tokenizer.convert_tokens_to_ids(placeholder_tokens)
+                    or not torch.equal(tokenize_prompt(tokenizer, texts), tokenize_prompt(slow_tokenizer, texts))):
+                logger.warning("The fast tokenizers give other ids than the slow ones for the placeholder, using the slow tokenizers.")
+                _FAST_TOKENIZER_CHECKS[key] = slow_tokenizers
+                break
+    slow_tokenizers = _FAST_TOKENIZER_CHECKS[key]
+    if slow_tokenizers is None:
+        return list(tokenizers)
+    # every loop gets its own copies, as the ones of `base_components`
+    return [copy.deepcopy(slow_tokenizer) for slow_tokenizer in slow_tokenizers]
+
+
+def text_encoders_trainable(optimizer, text_encoders):
+    """
+    whether the optimizer updates any parameter of the text encoders (input embeddings or lora layers)
+    """
+    text_params = {id(p) for text_encoder in text_encoders for p in text_encoder.parameters()}
+    return any(p.requires_grad and id(p) in text_params for group in optimizer.param_groups for p in group["params"])
+
+
+def precompute_prompt_embeds(dataset, text_encoders, batch_size=8):
+    """
+    encode the prompt of every template of the dataset once, for training with frozen text encoders
+    return: prompt embeds and pooled prompt embeds, indexed by the `template_ids` of the examples
+    """
+    ids_one, ids_two = dataset.template_input_ids_one, dataset.template_input_ids_two
+    prompt_embeds, pooled_prompt_embeds = [], []
+    with torch.no_grad():
+        for i in range(0, len(ids_one), batch_size):
+            embeds, pooled = encode_prompt(
+                text_encoders, None, None, text_input_ids_list=[ids_one[i : i + batch_size], ids_two[i : i + batch_size]]
+            )
+            prompt_embeds.append(embeds)
+            pooled_prompt_embeds.append(pooled)
+    return torch.cat(prompt_embeds), torch.cat(pooled_prompt_embeds)
+
+
+# frozen base components of the process, loaded once by `base_components`
+_BASE_COMPONENTS = {}
+
+
+def load_base_components(args):
+    """
+    load the tokenizers, the noise scheduler, the text encoders, the VAE and the UNet of the base model from disk
+    return: dict of the components
+    """
+    # Load the tokenizers
+    # dzc: Original CLIP tokenizer encoder
+    # the fast tokenizers are checked against the slow ones in `train`, see `check_fast_tokenizers`
+    use_fast = getattr(args, "fast_tokenizer", False)
+    tokenizer_one = AutoTokenizer.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision, use_fast=use_fast)
+    tokenizer_two = AutoTokenizer.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=args.revision, use_fast=use_fast)
+    
+    # import correct text encoder classes
+    text_encoder_cls_one = import_model_class_from_model_name_or_path(
+        args.pretrained_model_name_or_path, args.revision)
+    text_encoder_cls_two = import_model_class_from_model_name_or_path(
+        args.pretrained_model_name_or_path, args.revision, subfolder="text_encoder_2")
+
+    # Load scheduler and models
+    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
+    
+    # dzc: Original CLIP ViT-L text encoder, input token torch.tensor([int]), output shape [1, 768]
+    text_encoder_one = text_encoder_cls_one.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision
+    )
+    
+    # dzc: OpenCLIP ViT-bigG text encoder, input token torch.tensor([int]), output shape [1, 1280]
+    text_encoder_two = text_encoder_cls_two.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="text_encoder_2", revision=args.revision
+    )
+    vae_path = (
+        args.pretrained_model_name_or_path
+        if args.pretrained_vae_model_name_or_path is None
+        else args.pretrained_vae_model_name_or_path
+    )
+    vae = AutoencoderKL.from_pretrained(
+        vae_path, subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None, revision=args.revision
+    )
+    unet = UNet2DConditionModel.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision
+    )
+    return {
+        "tokenizer_one": tokenizer_one,
+        "tokenizer_two": tokenizer_two,
+        "noise_scheduler": noise_scheduler,
+        "text_encoder_one": text_encoder_one,
+        "text_encoder_two": text_encoder_two,
+        "vae": vae,
+        "unet": unet,
+    }
+
+
+def _remove_forward_wrappers(model):
+    # `accelerator.prepare` wraps the forward of a model for mixed precision, once more at every loop
+    if model.__dict__.pop("_original_forward", None) is not None:
+        model.__dict__.pop("forward", None)
+
+
+def base_weight_dtypes(args):
+    """
+    the dtypes `train` casts the frozen models of `args` to, as `Accelerator` resolves `mixed_precision`,
+    the base pipeline runs in the same ones, so that the weights it shares with the training
+    are rounded from float32 once, as if the training had loaded them from disk
+    return: (dtype of the text encoders and the unet, dtype of the vae)
+    """
+    mixed_precision = getattr(args, "mixed_precision", None) or os.environ.get("ACCELERATE_MIXED_PRECISION", "no")
+    weight_dtype = {"fp16": torch.float16, "bf16": torch.bfloat16}.get(mixed_precision, torch.float32)
+    # The VAE is in float32 to avoid NaN losses.
+    vae_dtype = torch.float32 if getattr(args, "pretrained_vae_model_name_or_path", None) is None else weight_dtype
+    return weight_dtype, vae_dtype
+
+
+def _base_key(args):
+    # the configs in other dtypes have their own copy, a cast to lower precision and back is lossy
+    return (args.pretrained_model_name_or_path, getattr(args, "pretrained_vae_model_name_or_path", None),
+            getattr(args, "revision", None), getattr(args, "fast_tokenizer", False), base_weight_dtypes(args))
+
+
+def _reset_base_models(components, original_embeds):
+    # text encoders with their original vocabulary and without lora layers, and a unet without lora layers
+    for name, embeds in zip(("text_encoder_one", "text_encoder_two"), original_embeds):
+        text_encoder = components[name]
+        _remove_forward_wrappers(text_encoder)
+        if isinstance(text_encoder.get_input_embeddings(), PlaceholderEmbedding):
+            text_encoder.set_input_embeddings(text_encoder.get_input_embeddings().embedding)
+        LoraLoaderMixin._remove_text_encoder_monkey_patch_classmethod(text_encoder)
+        text_encoder.resize_token_embeddings(embeds.shape[0])
+        weight = text_encoder.get_input_embeddings().weight
+        with torch.no_grad():
+            weight.copy_(embeds.to(weight.device, dtype=weight.dtype))
+    unet = components["unet"]
+    _remove_forward_wrappers(unet)
+    for attn_processor_name in unet.attn_processors:
+        attn_module = unet
+        for n in attn_processor_name.split(".")[:-1]:
+            attn_module = getattr(attn_module, n)
+        for linear in (attn_module.to_q, attn_module.to_k, attn_module.to_v, attn_module.to_out[0]):
+            linear.set_lora_layer(None)
+
+
+def base_components(args):
+    """
+    the base components of the model of `args`, loaded from disk on the first call of the process only,
+    every call hands out a clean view of them for one training loop: tokenizers without the placeholder tokens,
+    text encoders with their original vocabulary and without lora layers, and a unet without lora layers
+    return: dict of the components, see `load_base_components`
+    """
+    key = _base_key(args)
+    if key not in _BASE_COMPONENTS:
+        start = time.perf_counter()
+        components = load_base_components(args)
+        # the pristine vocabulary, the placeholder rows are added per loop
+        original_embeds = [
+            components[name].get_input_embeddings().weight.detach().cpu().clone()
+            for name in ("text_encoder_one", "text_encoder_two")
+        ]
+        _BASE_COMPONENTS[key] = (components, original_embeds)
+        logger.info(f"Loaded the base components of '{key[0]}' in {time.perf_counter() - start:.1f}s.")
+        components = dict(components)
+    else:
+        start = time.perf_counter()
+        components, original_embeds = _BASE_COMPONENTS[key]
+        components = dict(components)
+        _reset_base_models(components, original_embeds)
+        logger.info(f"Reused the base components of '{key[0]}', reset in {time.perf_counter() - start:.1f}s.")
+    # the placeholder tokens are added to copies of the tokenizers
+    components["tokenizer_one"] = copy.deepcopy(components["tokenizer_one"])
+    components["tokenizer_two"] = copy.deepcopy(components["tokenizer_two"])
+    return components
+
+
+def base_pipeline(args):
+    """
+    the base SDXL pipeline of the model of `args`, built around the text encoders, the VAE and the UNet of
+    `base_components`, so that the generation and the training of a process keep a single copy of the base model
+    in memory, the pipeline has its own tokenizers and scheduler, see `reset_base_pipeline`
+    return: the pipeline, in the dtypes of the training, see `base_weight_dtypes`
+    """
+    if not hasattr(args, "revision"):
+        # the run configs have no revision, as `train` sets it
+        args = argparse.Namespace(revision=None, **vars(args))
+    components = base_components(args)
+    pipe = StableDiffusionXLPipeline.from_pretrained(
+        args.pretrained_model_name_or_path,
+        vae=components["vae"],
+        text_encoder=components["text_encoder_one"],
+        text_encoder_2=components["text_encoder_two"],
+        unet=components["unet"],
+        revision=args.revision,
+    )
+    weight_dtype, vae_dtype = base_weight_dtypes(args)
+    for model in (pipe.text_encoder, pipe.text_encoder_2, pipe.unet):
+        model.to(dtype=weight_dtype)
+    pipe.vae.to(dtype=vae_dtype)
+    return pipe
+
+
+def reset_base_pipeline(pipe):
+    """
+    undo what the training loops left on the models a pipeline of `base_pipeline` shares with them
+    (placeholder rows and embedding, lora layers, mixed precision wrappers and training mode),
+    their dtypes are the ones of the training already, a no-op for other pipelines
+    """
+    for components, original_embeds in _BASE_COMPONENTS.values():
+        if components["unet"] is pipe.unet:
+            _reset_base_models(components, original_embeds)
+            for model in (pipe.text_encoder, pipe.text_encoder_2, pipe.vae, pipe.unet):
+                model.eval()
+            return
+
+
+def offload_base_components():
+    """
+    move the models of the base components to CPU memory between the training loops
+    """
+    for components, _ in _BASE_COMPONENTS.values():
+        for name in ("text_encoder_one", "text_encoder_two", "vae", "unet"):
+            components[name].to("cpu")
+    torch.cuda.empty_cache()
+
+
 def train(args, loop=0, loop_num = 0):
     # for Loop training
     if "output_dir_per_loop" in args:#
@@ -816,42 +1135,17 @@ def train(args, loop=0, loop_num = 0):
                 repo_id=args.hub_model_id or Path(args.output_dir).name, exist_ok=True, token=args.hub_token
             ).repo_id
 
-    # Load the tokenizers
-    # dzc: Original CLIP tokenizer encoder
-    tokenizer_one = AutoTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="tokenizer", revision=args.revision, use_fast=False)
-    tokenizer_two = AutoTokenizer.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="tokenizer_2", revision=args.revision, use_fast=False)
-    
-    # import correct text encoder classes
-    text_encoder_cls_one = import_model_class_from_model_name_or_path(
-        args.pretrained_model_name_or_path, args.revision)
-    text_encoder_cls_two = import_model_class_from_model_name_or_path(
-        args.pretrained_model_name_or_path, args.revision, subfolder="text_encoder_2")
-
-    # Load scheduler and models
-    noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_model_name_or_path, subfolder="scheduler")
-    
-    # dzc: Original CLIP ViT-L text encoder, input token torch.tensor([int]), output shape [1, 768]
-    text_encoder_one = text_encoder_cls_one.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="text_encoder", revision=args.revision
-    )
-    
-    # dzc: OpenCLIP ViT-bigG text encoder, input token torch.tensor([int]), output shape [1, 1280]
-    text_encoder_two = text_encoder_cls_two.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="text_encoder_2", revision=args.revision
-    )
+    # Load the tokenizers, scheduler and models, from disk on the first loop of the process only
+    components = base_components(args)
+    tokenizer_one, tokenizer_two = components["tokenizer_one"], components["tokenizer_two"]
+    noise_scheduler = components["noise_scheduler"]
+    text_encoder_one, text_encoder_two = components["text_encoder_one"], components["text_encoder_two"]
+    vae, unet = components["vae"], components["unet"]
     vae_path = (
         args.pretrained_model_name_or_path
         if args.pretrained_vae_model_name_or_path is None
         else args.pretrained_vae_model_name_or_path
     )
-    vae = AutoencoderKL.from_pretrained(
-        vae_path, subfolder="vae" if args.pretrained_vae_model_name_or_path is None else None, revision=args.revision
-    )
-    unet = UNet2DConditionModel.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="unet", revision=args.revision
-    )
     
     
     # ######################################################################
@@ -880,6 +1174,10 @@ def train(args, loop=0, loop_num = 0):
             " `placeholder_token` that is not already in the tokenizer."
         )
 
+    if getattr(args, "fast_tokenizer", False):
+        templates = imagenet_style_templates_small if args.learnable_property == "style" else imagenet_templates_small
+        tokenizer_one, tokenizer_two = check_fast_tokenizers(args, [tokenizer_one, tokenizer_two], placeholder_tokens, templates)
+
     # Convert the initializer_token, placeholder_token to ids, for example "cat" -> 5988
     token_ids_one = tokenizer_one.encode(args.initializer_token, add_special_tokens=False) 
     token_ids_two = tokenizer_two.encode(args.initializer_token, add_special_tokens=False) 
@@ -937,6 +1235,12 @@ def train(args, loop=0, loop_num = 0):
     text_encoder_one.to(accelerator.device, dtype=weight_dtype)
     text_encoder_two.to(accelerator.device, dtype=weight_dtype)
 
+    # Only the placeholder rows of the token embeddings are trainable, spliced into the embedding lookup
+    placeholder_embedding_one = PlaceholderEmbedding(text_encoder_one.get_input_embeddings(), placeholder_token_ids_one)
+    placeholder_embedding_two = PlaceholderEmbedding(text_encoder_two.get_input_embeddings(), placeholder_token_ids_two)
+    text_encoder_one.set_input_embeddings(placeholder_embedding_one)
+    text_encoder_two.set_input_embeddings(placeholder_embedding_two)
+
     if args.enable_xformers_memory_efficient_attention:
         if is_xformers_available():
             import xformers
@@ -1095,22 +1399,22 @@ def train(args, loop=0, loop_num = 0):
     # Optimizer creation, with textual inversion
     if args.text_inv:
         params_to_optimize_w_textual = (
-            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, text_encoder_one.get_input_embeddings().parameters(), text_encoder_two.get_input_embeddings().parameters())
+            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, [placeholder_embedding_one.rows, placeholder_embedding_two.rows])
             if args.train_text_encoder
-            else itertools.chain(text_encoder_one.get_input_embeddings().parameters(), text_encoder_two.get_input_embeddings().parameters())
+            else itertools.chain([placeholder_embedding_one.rows, placeholder_embedding_two.rows])
         )
     if args.lora:
         params_to_optimize_w_textual = (
-            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, text_encoder_one.get_input_embeddings().parameters(), text_encoder_two.get_input_embeddings().parameters())
+            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, [placeholder_embedding_one.rows, placeholder_embedding_two.rows])
             if args.train_text_encoder
             else itertools.chain(unet_lora_parameters)
         )
     else:
         # lora + text-inv
         params_to_optimize_w_textual = (
-            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, text_encoder_one.get_input_embeddings().parameters(), text_encoder_two.get_input_embeddings().parameters())
+            itertools.chain(unet_lora_parameters, text_lora_parameters_one, text_lora_parameters_two, [placeholder_embedding_one.rows, placeholder_embedding_two.rows])
             if args.train_text_encoder
-            else itertools.chain(unet_lora_parameters, text_encoder_one.get_input_embeddings().parameters(), text_encoder_two.get_input_embeddings().parameters())
+            else itertools.chain(unet_lora_parameters, [placeholder_embedding_one.rows, placeholder_embedding_two.rows])
         )
     
     optimizer = optimizer_class(
@@ -1120,6 +1424,11 @@ def train(args, loop=0, loop_num = 0):
         weight_decay=args.adam_weight_decay,
         eps=args.adam_epsilon,
     )
+    
+    # the placeholder rows only get gradients when the optimizer trains them
+    optimized_params = {id(p) for group in optimizer.param_groups for p in group["params"]}
+    for placeholder_embedding in (placeholder_embedding_one, placeholder_embedding_two):
+        placeholder_embedding.rows.requires_grad_(id(placeholder_embedding.rows) in optimized_params)
 
     # Get the datasets: you can either provide your own training and evaluation files (see below)
     # or specify a Dataset from the hub (the dataset will be downloaded automatically from the datasets Hub).
@@ -1270,9 +1579,54 @@ def train(args, loop=0, loop_num = 0):
     #     num_workers=args.dataloader_num_workers,
     # )
     
+    # encode every variant of the training images once (`latent_cache`: memory or disk), instead of every step
+    latent_cache_mode = getattr(args, "latent_cache", "none")
+    if latent_cache_mode != "none":
+        # the latents handed over from the generation replace encoded ones, they are part of the key
+        latents_dir = getattr(args, "train_latents_dir_per_loop", None)
+        handoff = None
+        if latents_dir is not None:
+            handoff_paths = [os.path.join(latents_dir, os.path.splitext(os.path.basename(p))[0] + ".npy")
+                             for p in train_dataset.image_paths]
+            handoff = [(p, os.path.getmtime(p)) for p in handoff_paths if os.path.exists(p)]
+        key = dict(images=[(p, os.path.getsize(p), os.path.getmtime(p)) for p in train_dataset.image_paths],
+                   resolution=args.resolution, center_crop=args.center_crop, random_flip=args.random_flip,
+                   num_crops=getattr(args, "latent_crop_variants", 4), vae=vae_path, handoff=handoff)
+        train_dataset.latent_cache = LatentCache.build(
+            train_dataset, vae, num_crops=key["num_crops"],
+            latents_dir=latents_dir,
+            cache_path=os.path.join(args.train_data_dir, ".latents.pt") if latent_cache_mode == "disk" else None,
+            key=key)
+    
+    # otherwise decode and resize every training image once, into a memory-mapped array
+    elif getattr(args, "image_store", True):
+        key = dict(images=[(p, os.path.getsize(p), os.path.getmtime(p)) for p in train_dataset.image_paths],
+                   resolution=args.resolution)
+        train_dataset.image_store = ImageStore.build(
+            train_dataset.image_paths, train_dataset.train_resize,
+            os.path.join(args.train_data_dir, f".images_{args.resolution}.npy"), key=key)
+    
+    # Frozen text encoders give the same prompt embeddings at every step: encode every template once,
+    # and keep the text encoders off the device until they are needed for the validation.
+    prompt_embeds_cache = None
+    if getattr(args, "prompt_embeds_cache", True) and not text_encoders_trainable(optimizer, [text_encoder_one, text_encoder_two]):
+        prompt_embeds_cache = precompute_prompt_embeds(train_dataset, [text_encoder_one, text_encoder_two])
+        text_encoder_one.to("cpu")
+        text_encoder_two.to("cpu")
+        torch.cuda.empty_cache()
+        logger.info(f"[{loop}/{loop_num}] Cached the prompt embeddings of {len(train_dataset.templates)} templates, the text encoders are frozen.")
+    
     # # DataLoaders creation: using the textual inversion format
     train_dataloader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=args.train_batch_size, shuffle=True, num_workers=args.dataloader_num_workers
+        train_dataset,
+        batch_size=args.train_batch_size,
+        shuffle=True,
+        collate_fn=collate_fn,
+        num_workers=args.dataloader_num_workers,
+        # no worker respawn at every epoch of the few training images
+        persistent_workers=args.dataloader_num_workers > 0,
+        # the uint8 crops of the image store are copied to the device asynchronously
+        pin_memory=torch.cuda.is_available(),
     )
 
     # Scheduler and math around the number of training steps.
@@ -1360,11 +1714,68 @@ def train(args, loop=0, loop_num = 0):
         disable=not accelerator.is_local_main_process,
     )
     
-    # keep original embeddings as reference
-    orig_embeds_params_one = accelerator.unwrap_model(text_encoder_one).get_input_embeddings().weight.data.clone()
-    orig_embeds_params_two = accelerator.unwrap_model(text_encoder_two).get_input_embeddings().weight.data.clone()
-    
+    # Validation every `validation_steps` steps (every `validation_epochs` epochs without it), with one pipeline
+    # of the live modules, built at the first validation and reused by the others and by the final test
+    validation_steps = getattr(args, "validation_steps", None)
+    validation_pipeline = None
+    validation_time, num_validations = 0.0, 0
+
+    def render_validation(tag, step, num_inference_steps=50):
+        nonlocal validation_pipeline, validation_time, num_validations
+        start = time.perf_counter()
+        logger.info(
+            f"[{loop}/{loop_num}] Running {tag}... \n Generating {args.num_validation_images} images with prompt:"
+            f" {args.validation_prompt}."
+        )
+        if validation_pipeline is None:
+            # only the inference scheduler is read from disk, the models and tokenizers are the trained ones
+            validation_pipeline = StableDiffusionXLPipeline.from_pretrained(
+                args.pretrained_model_name_or_path,
+                vae=vae,
+                text_encoder=accelerator.unwrap_model(text_encoder_one),
+                text_encoder_2=accelerator.unwrap_model(text_encoder_two),
+                tokenizer=tokenizer_one,
+                tokenizer_2=tokenizer_two,
+                unet=accelerator.unwrap_model(unet),
+                revision=args.revision,
+                torch_dtype=weight_dtype,
+            )
+            validation_pipeline.set_progress_bar_config(disable=True)
+        validation_pipeline.to(accelerator.device)
+
+        # all the images in one call, each with its own generator
+        seeds = [args.seed + i if args.seed else random.randrange(2**32) for i in range(args.num_validation_images)]
+        with torch.cuda.amp.autocast():
+            images = generate_images_batched(
+                validation_pipeline, args.validation_prompt, num_inference_steps, seeds,
+                guidance_scale=5.0, device=accelerator.device,
+            )
+
+        for tracker in accelerator.trackers:
+            if tracker.name == "tensorboard":
+                np_images = np.stack([np.asarray(img) for img in images])
+                tracker.writer.add_images(tag, np_images, step, dataformats="NHWC")
+            if tracker.name == "wandb":
+                tracker.log(
+                    {
+                        tag: [
+                            wandb.Image(image, caption=f"{i}: {args.validation_prompt}")
+                            for i, image in enumerate(images)
+                        ]
+                    }
+                )
+
+        if prompt_embeds_cache is not None:
+            # the pipeline moved the text encoders back to the device
+            text_encoder_one.to("cpu")
+            text_encoder_two.to("cpu")
+        torch.cuda.empty_cache()
+        validation_time += time.perf_counter() - start
+        num_validations += 1
+        return images
+
     logger.info(f"[{loop}/{loop_num}] Start Training!")
+    train_start = time.perf_counter()
     
     for epoch in range(first_epoch, args.num_train_epochs):
         unet.train()
@@ -1373,20 +1784,25 @@ def train(args, loop=0, loop_num = 0):
             text_encoder_two.train()
         train_loss = 0.0
         for step, batch in enumerate(train_dataloader):
-            batch["original_sizes"] = (batch["original_sizes"][0].cpu().item(), batch["original_sizes"][1].cpu().item())
-            batch["crop_top_lefts"] = (batch["crop_top_lefts"][0].cpu().item(), batch["crop_top_lefts"][1].cpu().item())
             with accelerator.accumulate(unet):
-                # Convert images to latent space
-                if args.pretrained_vae_model_name_or_path is not None:
-                    pixel_values = batch["pixel_values"].to(dtype=weight_dtype)
+                if "latent_params" in batch:
+                    # only sample from the cached latent distribution of the images
+                    model_input = sample_latents(batch["latent_params"].to(accelerator.device))
+                    model_input = (model_input * vae.config.scaling_factor).to(weight_dtype)
                 else:
                     pixel_values = batch["pixel_values"]
-                    
-                # Convert images to latent space
-                model_input = vae.encode(pixel_values).latent_dist.sample()
-                model_input = model_input * vae.config.scaling_factor
-                if args.pretrained_vae_model_name_or_path is None:
-                    model_input = model_input.to(weight_dtype)
+                    if pixel_values.dtype == torch.uint8:
+                        # the stored images, normalized to [-1, 1] as `train_transforms` does
+                        pixel_values = pixel_values.to(accelerator.device, non_blocking=True).float() / 127.5 - 1.0
+                    # Convert images to latent space
+                    if args.pretrained_vae_model_name_or_path is not None:
+                        pixel_values = pixel_values.to(dtype=weight_dtype)
+                        
+                    # Convert images to latent space
+                    model_input = vae.encode(pixel_values).latent_dist.sample()
+                    model_input = model_input * vae.config.scaling_factor
+                    if args.pretrained_vae_model_name_or_path is None:
+                        model_input = model_input.to(weight_dtype)
 
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(model_input)
@@ -1408,29 +1824,31 @@ def train(args, loop=0, loop_num = 0):
                 noisy_model_input = noise_scheduler.add_noise(model_input, noise, timesteps)
 
                 # time ids
-                def compute_time_ids(original_size, crops_coords_top_left):
-                    # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids
-                    target_size = (args.resolution, args.resolution)
-                    add_time_ids = list(original_size + crops_coords_top_left + target_size)
-                    add_time_ids = torch.tensor([add_time_ids])
-                    add_time_ids = add_time_ids.to(accelerator.device, dtype=weight_dtype)
-                    return add_time_ids
-
-                # TODO: support batch size > 1
-                original_sizes = batch["original_sizes"]
-                crop_top_lefts = batch["crop_top_lefts"]
-                add_time_ids = torch.cat(
-                    [compute_time_ids(original_sizes, crop_top_lefts)]
-                )
+                def compute_time_ids(original_sizes, crops_coords_top_lefts):
+                    # Adapted from pipeline.StableDiffusionXLPipeline._get_add_time_ids, one row per sample
+                    original_sizes = original_sizes.to(accelerator.device)
+                    target_sizes = torch.tensor([args.resolution, args.resolution], device=accelerator.device)
+                    add_time_ids = torch.cat(
+                        [original_sizes, crops_coords_top_lefts.to(accelerator.device), target_sizes.expand_as(original_sizes)],
+                        dim=1,
+                    )
+                    return add_time_ids.to(dtype=weight_dtype)
+
+                add_time_ids = compute_time_ids(batch["original_sizes"], batch["crop_top_lefts"])
 
                 # Predict the noise residual
                 unet_added_conditions = {"time_ids": add_time_ids}
-                prompt_embeds, pooled_prompt_embeds = encode_prompt(
-                    text_encoders=[text_encoder_one, text_encoder_two],
-                    tokenizers=None,
-                    prompt=None,
-                    text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
-                )
+                if prompt_embeds_cache is not None:
+                    template_ids = batch["template_ids"].to(prompt_embeds_cache[0].device)
+                    prompt_embeds = prompt_embeds_cache[0][template_ids]
+                    pooled_prompt_embeds = prompt_embeds_cache[1][template_ids]
+                else:
+                    prompt_embeds, pooled_prompt_embeds = encode_prompt(
+                        text_encoders=[text_encoder_one, text_encoder_two],
+                        tokenizers=None,
+                        prompt=None,
+                        text_input_ids_list=[batch["input_ids_one"], batch["input_ids_two"]],
+                    )
                 unet_added_conditions.update({"text_embeds": pooled_prompt_embeds})
                 model_pred = unet(
                     noisy_model_input, timesteps, prompt_embeds, added_cond_kwargs=unet_added_conditions
@@ -1482,22 +1900,6 @@ def train(args, loop=0, loop_num = 0):
                 optimizer.step()
                 lr_scheduler.step()
                 optimizer.zero_grad()
-                
-                # dzc: Let's make sure we don't update any embedding weights besides the newly added token
-                index_no_updates_one = torch.ones((len(tokenizer_one),), dtype=torch.bool)
-                index_no_updates_one[min(placeholder_token_ids_one) : max(placeholder_token_ids_one) + 1] = False
-                
-                index_no_updates_two = torch.ones((len(tokenizer_two),), dtype=torch.bool)
-                index_no_updates_two[min(placeholder_token_ids_two) : max(placeholder_token_ids_two) + 1] = False
-                
-                with torch.no_grad():
-                    accelerator.unwrap_model(text_encoder_one).get_input_embeddings().weight[
-                        index_no_updates_one
-                    ] = orig_embeds_params_one[index_no_updates_one]
-                    
-                    accelerator.unwrap_model(text_encoder_two).get_input_embeddings().weight[
-                        index_no_updates_two
-                    ] = orig_embeds_params_two[index_no_updates_two]
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
@@ -1532,60 +1934,25 @@ def train(args, loop=0, loop_num = 0):
                         accelerator.save_state(save_path)
                         logger.info(f"Saved state to {save_path}")
 
+                    # the last step is left to the final test, which renders the same weights right after
+                    if (args.validation_prompt is not None and validation_steps is not None
+                            and global_step % validation_steps == 0 and global_step < args.max_train_steps):
+                        render_validation("validation", global_step)
+
             logs = {"step_loss": loss.detach().item(), "lr": lr_scheduler.get_last_lr()[0]}
             progress_bar.set_postfix(**logs)
 
             if global_step >= args.max_train_steps:
                 break
 
-        if accelerator.is_main_process:
+        if accelerator.is_main_process and validation_steps is None:
             if args.validation_prompt is not None and epoch % args.validation_epochs == 0:
-                logger.info(f"[{loop}/{loop_num}] Validating and generating images for validation in tensoirboard / wandb.")
-                
-                logger.info(
-                    f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
-                    f" {args.validation_prompt}."
-                )
-                # create pipeline
-                pipeline = StableDiffusionXLPipeline.from_pretrained(
-                    args.pretrained_model_name_or_path,
-                    vae=vae,
-                    text_encoder=accelerator.unwrap_model(text_encoder_one),
-                    text_encoder_2=accelerator.unwrap_model(text_encoder_two),
-                    unet=accelerator.unwrap_model(unet),
-                    revision=args.revision,
-                    torch_dtype=weight_dtype,
-                )
+                render_validation("validation", epoch)
 
-                pipeline = pipeline.to(accelerator.device)
-                pipeline.set_progress_bar_config(disable=True)
-
-                # run inference
-                generator = torch.Generator(device=accelerator.device).manual_seed(args.seed) if args.seed else None
-                pipeline_args = {"prompt": args.validation_prompt}
-
-                with torch.cuda.amp.autocast():
-                    images = [
-                        pipeline(**pipeline_args, generator=generator).images[0]
-                        for _ in range(args.num_validation_images)
-                    ]
-
-                for tracker in accelerator.trackers:
-                    if tracker.name == "tensorboard":
-                        np_images = np.stack([np.asarray(img) for img in images])
-                        tracker.writer.add_images("validation", np_images, epoch, dataformats="NHWC")
-                    if tracker.name == "wandb":
-                        tracker.log(
-                            {
-                                "validation": [
-                                    wandb.Image(image, caption=f"{i}: {args.validation_prompt}")
-                                    for i, image in enumerate(images)
-                                ]
-                            }
-                        )
-
-                del pipeline
-                torch.cuda.empty_cache()
+    # Write the learned placeholder rows back into the token embeddings
+    for text_encoder in (text_encoder_one, text_encoder_two):
+        text_encoder = accelerator.unwrap_model(text_encoder)
+        text_encoder.set_input_embeddings(text_encoder.get_input_embeddings().merge())
 
     # Save the lora layers
     logger.info(f"[{loop}/{loop_num}] Saving lora layers")
@@ -1612,39 +1979,13 @@ def train(args, loop=0, loop_num = 0):
         )
 
         # Final inference
-        # Load previous pipeline
+        # The trained models already carry the saved lora layers, the validation pipeline renders the test images
         logger.info(f"[{loop}/{loop_num}] Testing and generating images for testing in tensoirboard / wandb.")
-        
-        pipeline = StableDiffusionXLPipeline.from_pretrained(
-            args.pretrained_model_name_or_path, vae=vae, revision=args.revision, torch_dtype=weight_dtype
-        )
-        pipeline = pipeline.to(accelerator.device)
-
-        # load attention processors
-        pipeline.load_lora_weights(args.output_dir)
-
-        # run inference
         images = []
         if args.validation_prompt and args.num_validation_images > 0:
-            generator = torch.Generator(device=accelerator.device).manual_seed(args.seed) if args.seed else None
-            images = [
-                pipeline(args.validation_prompt, num_inference_steps=25, generator=generator).images[0]
-                for _ in range(args.num_validation_images)
-            ]
-
-            for tracker in accelerator.trackers:
-                if tracker.name == "tensorboard":
-                    np_images = np.stack([np.asarray(img) for img in images])
-                    tracker.writer.add_images("test", np_images, epoch, dataformats="NHWC")
-                if tracker.name == "wandb":
-                    tracker.log(
-                        {
-                            "test": [
-                                wandb.Image(image, caption=f"{i}: {args.validation_prompt}")
-                                for i, image in enumerate(images)
-                            ]
-                        }
-                    )
+            images = render_validation("test", epoch, num_inference_steps=25)
+        logger.info((f"[{loop}/{loop_num}] Training {time.perf_counter() - train_start - validation_time:.1f}s, "
+                     f"validation {validation_time:.1f}s ({num_validations} runs, including the test)."))
 
         # Save the full model for textual inversion
         if args.push_to_hub and not args.save_as_full_pipeline:
@@ -1690,6 +2031,21 @@ def train(args, loop=0, loop_num = 0):
             safe_serialization=not args.no_safe_serialization,
         )
 
+        # The loop artifact: the lora weights and the learned embeddings above, and a manifest to rebuild
+        # the pipeline from the shared base model (see `main.load_trained_pipeline`)
+        save_adapter_manifest(
+            args.output_dir,
+            base_fingerprint(args.pretrained_model_name_or_path, args.pretrained_vae_model_name_or_path, unet.config, vae.config),
+            base_model=args.pretrained_model_name_or_path,
+            vae=args.pretrained_vae_model_name_or_path,
+            revision=args.revision,
+            lora_weights="pytorch_lora_weights.safetensors",
+            embeds=[weight_name_one, weight_name_two],
+            placeholder_token=args.placeholder_token,
+            placeholder_tokens=tokenizer_one.convert_ids_to_tokens(placeholder_token_ids_one),
+            initializer_token=args.initializer_token,
+            train_text_encoder=bool(args.train_text_encoder),
+        )
         
         if args.push_to_hub:
             save_model_card(
@@ -1714,7 +2070,9 @@ def train(args, loop=0, loop_num = 0):
         del text_encoder_lora_layers
         del text_encoder_2_lora_layers
         torch.cuda.empty_cache()
-        
+    
+    # the base components stay in CPU memory for the next loop
+    offload_base_components()
     accelerator.end_training()
 
 
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+from utils.clustering import KMEANS_BACKENDS, fit_kmeans
+
+
+def _blobs(n=300, k=4, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    truth = rng.normal(size=(k, dim)) * 10
+    labels = rng.integers(k, size=n)
+    return (truth[labels] + rng.normal(size=(n, dim))).astype(np.float32), labels
+
+
+def _same_partition(a, b):
+    # equal up to a renaming of the clusters
+    return len(set(zip(a, b))) == len(set(a)) == len(set(b))
+
+
+@pytest.mark.parametrize("backend", KMEANS_BACKENDS)
+def test_backends_recover_separated_blobs(backend):
+    x, truth = _blobs()
+    centers, labels, inertia = fit_kmeans(x, 4, backend=backend, n_init=4, batch_size=64)
+    assert centers.shape == (4, x.shape[1])
+    assert labels.shape == (len(x),)
+    assert _same_partition(labels, truth)
+    ref_inertia = ((x - centers[labels]) ** 2).sum()
+    assert np.isclose(inertia, ref_inertia, rtol=1e-3)
+
+
+@pytest.mark.parametrize("backend", KMEANS_BACKENDS)
+def test_backends_are_deterministic(backend):
+    x, _ = _blobs(n=200, k=6, seed=1)
+    first = fit_kmeans(x, 6, backend=backend, n_init=2, seed=3, batch_size=64)
+    second = fit_kmeans(x, 6, backend=backend, n_init=2, seed=3, batch_size=64)
+    assert np.array_equal(first[1], second[1])
+    assert np.allclose(first[0], second[0])
+
+
+def test_torch_restarts_match_sklearn_inertia():
+    # more clusters than blobs, the restarts end in different local minima
+    x, _ = _blobs(n=400, k=5, seed=2)
+    _, _, ref_inertia = fit_kmeans(x, 8, backend='sklearn', n_init=8)
+    _, _, inertia = fit_kmeans(x, 8, backend='torch', n_init=8)
+    assert inertia <= ref_inertia * 1.02
+
+
+def test_invalid_backend():
+    with pytest.raises(ValueError):
+        fit_kmeans(np.zeros((4, 2)), 2, backend='faiss')
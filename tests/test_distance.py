@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+from utils.distance import (SequentialConvergenceTest, estimate_mean_pairwise_distance, mean_pairwise_distance,
+                            pool_distance)
+
+
+def _points(n, dim=64, seed=0):
+    return np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32) * 3
+
+
+def _cdist_mean(x):
+    return np.mean(cdist(x, x, 'euclidean'))
+
+
+@pytest.mark.parametrize("n, block_size", [(1, 4), (2, 1), (2, 4), (7, 3), (128, 32), (130, 32), (300, 256)])
+def test_numpy_tiles_match_cdist(n, block_size):
+    x = _points(n)
+    assert np.isclose(mean_pairwise_distance(x, block_size=block_size), _cdist_mean(x), rtol=1e-6)
+
+
+@pytest.mark.parametrize("n, block_size", [(1, 4), (2, 1), (7, 3), (130, 32)])
+def test_torch_tiles_match_cdist(n, block_size):
+    pytest.importorskip("torch")
+    x = _points(n)
+    assert np.isclose(mean_pairwise_distance(x, block_size=block_size, backend="torch"), _cdist_mean(x), rtol=1e-6)
+
+
+def test_empty_pool_and_invalid_backend():
+    assert mean_pairwise_distance(np.zeros((0, 8))) == 0.0
+    with pytest.raises(ValueError):
+        mean_pairwise_distance(_points(4), backend="cupy")
+
+
+@pytest.mark.parametrize("n", [2, 50, 400])
+def test_random_pair_estimate_within_tolerance(n):
+    x = _points(n)
+    approx, std_err = estimate_mean_pairwise_distance(x, num_pairs=20000, seed=1)
+    # with N=2 every pair is the same, the estimate is exact
+    assert abs(approx - _cdist_mean(x)) <= 5 * std_err + 1e-6 * _cdist_mean(x)
+
+
+def test_random_pair_estimate_of_a_single_point():
+    assert estimate_mean_pairwise_distance(_points(1)) == (0.0, 0.0)
+
+
+def test_pool_distance_picks_the_estimator():
+    x = _points(100)
+    assert pool_distance(x) == pytest.approx(_cdist_mean(x), rel=1e-6)
+    assert pool_distance(x, num_pairs=5000) == estimate_mean_pairwise_distance(x, num_pairs=5000)[0]
+
+
+def test_sequential_estimate_over_the_whole_pool_is_exact():
+    x = _points(128, seed=2).astype(np.float64)
+    test = SequentialConvergenceTest(threshold=0.0, pool_size=len(x), min_samples=len(x) + 1)
+    for emb in x:
+        assert test.update(emb) is None
+    assert np.isclose(test.estimate(), _cdist_mean(x), rtol=1e-9)
+
+
+@pytest.mark.parametrize("scale, decision", [(0.8, 'not_converged'), (1.2, 'converged')])
+def test_sequential_decision_before_the_end_of_the_pool(scale, decision):
+    x = _points(256, seed=3)
+    test = SequentialConvergenceTest(threshold=scale * _cdist_mean(x), pool_size=len(x))
+    for emb in x:
+        if test.update(emb):
+            break
+    assert test.decision == decision
+    assert test.decided_at < len(x)
+
+
+def _clustered_points(n, seed, dim=64):
+    # a few clusters of uneven sizes and spreads, the first images may miss the smallest ones
+    rng = np.random.default_rng(seed)
+    k = rng.integers(2, 7)
+    labels = rng.choice(k, size=n, p=rng.dirichlet(np.full(k, 0.7)))
+    centers = rng.normal(size=(k, dim)) * rng.uniform(0.5, 3)
+    spreads = rng.uniform(0.3, 3.0, size=k) / np.sqrt(dim)
+    return centers[labels] + rng.normal(size=(n, dim)) * spreads[labels][:, None]
+
+
+def test_sequential_rarely_stops_clustered_pools_above_the_threshold():
+    num_pools, false_stops = 400, 0
+    for seed in range(num_pools):
+        x = _clustered_points(128, seed)
+        # the pool is 5 to 15% above the threshold
+        above = np.random.default_rng(seed + num_pools).uniform(1.05, 1.15)
+        test = SequentialConvergenceTest(threshold=_cdist_mean(x) / above, pool_size=len(x))
+        for emb in x:
+            if test.update(emb):
+                break
+        false_stops += test.decision == 'converged'
+    assert false_stops <= 0.005 * num_pools
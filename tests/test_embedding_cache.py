@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.embedding_cache import EmbeddingCache
+
+
+@pytest.fixture
+def images(tmp_path):
+    paths = []
+    for i in range(4):
+        path = tmp_path / f"{i}.png"
+        path.write_bytes(f"image {i}".encode())
+        paths.append(str(path))
+    return paths
+
+
+def _embs(n, offset=0):
+    return np.arange(offset, offset + n * 3, dtype=np.float32).reshape(n, 3)
+
+
+def test_lookup_after_reload(tmp_path, images):
+    cache_dir = str(tmp_path / "cache")
+    EmbeddingCache(cache_dir, "dinov2").save("0", images, _embs(4))
+    _, embs = EmbeddingCache(cache_dir, "dinov2").lookup(images[::-1])
+    assert np.array_equal(np.stack(embs), _embs(4)[::-1])
+    _, embs = EmbeddingCache(cache_dir, "other").lookup(images)
+    assert all(emb is None for emb in embs)
+
+
+def test_save_replaces_the_group_and_its_array(tmp_path, images):
+    cache_dir = str(tmp_path / "cache")
+    cache = EmbeddingCache(cache_dir, "dinov2")
+    cache.save("0", images[:2], _embs(2))
+    cache.save("0", images[2:], _embs(2, offset=100))
+    assert len([f for f in os.listdir(cache_dir) if f.endswith(".npy")]) == 1
+    _, embs = EmbeddingCache(cache_dir, "dinov2").lookup(images)
+    assert embs[0] is None and np.array_equal(embs[2], _embs(2, offset=100)[0])
+
+
+def test_interrupted_save_keeps_the_previous_group(tmp_path, images, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+    EmbeddingCache(cache_dir, "dinov2").save("0", images, _embs(4))
+
+    # a crash once the new array is written, before its index
+    def _crash(*args, **kwargs):
+        raise KeyboardInterrupt
+    monkeypatch.setattr("utils.embedding_cache.write_json_atomic", _crash)
+    with pytest.raises(KeyboardInterrupt):
+        EmbeddingCache(cache_dir, "dinov2").save("0", images[::-1], _embs(4, offset=100))
+    monkeypatch.undo()
+
+    _, embs = EmbeddingCache(cache_dir, "dinov2").lookup(images)
+    assert np.array_equal(np.stack(embs), _embs(4))
+
+
+def test_array_of_another_size_is_rejected(tmp_path, images):
+    cache_dir = str(tmp_path / "cache")
+    EmbeddingCache(cache_dir, "dinov2").save("0", images, _embs(4))
+    array_path = next(os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".npy"))
+    np.save(array_path, _embs(3))
+    _, embs = EmbeddingCache(cache_dir, "dinov2").lookup(images)
+    assert all(emb is None for emb in embs)
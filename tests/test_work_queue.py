@@ -0,0 +1,151 @@
+import argparse
+import os
+import threading
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from utils.generation import derive_seed, generate_images_batched, iter_pool_images
+from utils.work_queue import WorkQueue, run_worker
+
+
+class StandInPipeline:
+    """Tiny CPU stand-in for the diffusion pipeline, to test the sharded generation.
+
+    Called like a diffusers pipeline, it renders a small image per generator: random
+    blocks whose color depends on the generator seed, so identical seeds give identical images.
+    """
+    device = "cpu"
+
+    def __init__(self, size=64, grid=4):
+        self.size = size
+        self.grid = grid
+
+    def __call__(self, prompt, num_inference_steps=1, guidance_scale=7.5, generator=None, **kwargs):
+        images = []
+        for gen in generator:
+            blocks = torch.rand((self.grid, self.grid, 3), generator=gen)
+            pixels = (blocks.repeat_interleave(self.size // self.grid, 0)
+                            .repeat_interleave(self.size // self.grid, 1) * 255).to(torch.uint8).numpy()
+            images.append(Image.fromarray(pixels))
+        return SimpleNamespace(images=images)
+
+
+def stand_in_features(images):
+    """Stand-in feature extractor, the 8x8 thumbnails of the images or image paths."""
+    images = [Image.open(image).convert('RGB') if isinstance(image, str) else image for image in images]
+    return np.stack([np.asarray(image.resize((8, 8)), dtype=np.float32).reshape(-1) / 255 for image in images])
+
+
+def _items(num_items, loop_id=0):
+    return [{"key": str(i), "img_id": i, "seed": derive_seed(loop_id, i)} for i in range(num_items)]
+
+
+def _expire(path):
+    os.utime(path, (0, 0))
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WorkQueue(str(tmp_path / "queue"), lease_seconds=60)
+
+
+def test_claim_leases_each_item_once(queue):
+    queue.publish("loop_0", {"loop_id": 0}, _items(5))
+    first = queue.claim("loop_0", "a", max_items=3)
+    second = queue.claim("loop_0", "b", max_items=3)
+    assert [item["key"] for item in first] == ["0", "1", "2"]
+    assert [item["key"] for item in second] == ["3", "4"]
+    assert queue.claim("loop_0", "c", max_items=3) == []
+
+
+def test_complete_and_results(queue):
+    queue.publish("loop_0", {"loop_id": 0}, _items(3))
+    for item in queue.claim("loop_0", "a", max_items=2):
+        queue.complete("loop_0", item, np.full(4, item["img_id"], dtype=np.float32))
+    results = queue.results("loop_0")
+    assert queue.num_done("loop_0") == 2
+    assert np.array_equal(results[1], np.full(4, 1, dtype=np.float32))
+    assert results[2] is None
+
+
+def test_expired_lease_is_taken_over(queue):
+    queue.publish("loop_0", {"loop_id": 0}, _items(2))
+    assert len(queue.claim("loop_0", "crashed", max_items=2)) == 2
+    _expire(os.path.join(queue.queue_dir, "loop_0", "leases", "0.1"))
+    assert [item["key"] for item in queue.claim("loop_0", "b", max_items=2)] == ["0"]
+    assert os.path.exists(os.path.join(queue.queue_dir, "loop_0", "leases", "0.2"))
+
+
+def test_republish_keeps_or_replaces_the_done_items(queue):
+    spec, items = {"loop_id": 0}, _items(2)
+    queue.publish("loop_0", spec, items)
+    queue.complete("loop_0", items[0], np.zeros(1))
+    queue.publish("loop_0", spec, items)
+    assert queue.num_done("loop_0") == 1
+    queue.publish("loop_0", {"loop_id": 0, "infer_steps": 2}, items)
+    assert queue.num_done("loop_0") == 0
+
+
+def test_close_and_open(queue):
+    assert not queue.closed
+    queue.close()
+    assert queue.closed
+    queue.open()
+    assert not queue.closed
+
+
+def test_worker_prepares_again_on_a_new_spec(queue):
+    prepared = []
+    queue.publish("loop_0", {"adapters": "a"}, _items(2))
+
+    def _process(spec, items):
+        if spec["adapters"] == "a":
+            # the loop is run again with other adapters under the same job name
+            queue.publish("loop_0", {"adapters": "b"}, [{"key": f"b{i}"} for i in range(2)])
+        return [np.zeros(1) for _ in items]
+
+    run_worker(queue, prepared.append, _process, batch_size=2, poll_interval=0.01, idle_timeout=0.05)
+    assert prepared == [{"adapters": "a"}, {"adapters": "b"}]
+
+
+def test_sharded_pool_equals_single_process(tmp_path, queue):
+    num_images, num_workers = 24, 3
+    pool_dir = tmp_path / "pool"
+    pool_dir.mkdir()
+    spec = {"loop_id": 0, "pool_dir": str(pool_dir), "prompt": "", "infer_steps": 1}
+    # an expired lease of a crashed worker
+    os.makedirs(os.path.join(queue.queue_dir, "loop_0", "leases"))
+    crashed_lease = os.path.join(queue.queue_dir, "loop_0", "leases", "0.1")
+    open(crashed_lease, 'w').close()
+    _expire(crashed_lease)
+    queue.publish("loop_0", spec, _items(num_images))
+
+    def _process(spec, items):
+        images = generate_images_batched(StandInPipeline(), spec["prompt"], spec["infer_steps"],
+                                         [item["seed"] for item in items])
+        for item, image in zip(items, images):
+            image.save(os.path.join(spec["pool_dir"], f"{item['img_id']}.png"))
+        return stand_in_features(images)
+
+    workers = [threading.Thread(target=run_worker, args=(queue, lambda spec: None, _process),
+                                kwargs={"worker_id": f"w{i}", "batch_size": 2, "poll_interval": 0.01,
+                                        "idle_timeout": 30})
+               for i in range(num_workers)]
+    for worker in workers:
+        worker.start()
+    sharded = np.stack(queue.wait("loop_0", poll_interval=0.01, timeout=60))
+    queue.close()
+    for worker in workers:
+        worker.join()
+
+    ref_args = argparse.Namespace(num_of_generated_img=num_images, inference_prompt="", infer_steps=1,
+                                  seed=0, gen_batch_size=4)
+    ref_dir = tmp_path / "ref"
+    ref_dir.mkdir()
+    ref = stand_in_features([image for _, image, _ in iter_pool_images(StandInPipeline(), ref_args, str(ref_dir), 0)])
+    assert np.array_equal(sharded, ref)
+    assert sorted(os.listdir(pool_dir)) == sorted(f"{i}.png" for i in range(num_images))
@@ -13,3 +13,13 @@ CUDA_VISIBLE_DEVICES=2 python main.py \
 
 # CUDA_VISIBLE_DEVICES=3 python main.py \
 #     --config_file config/tco_child.yaml
+
+# all the characters in one process sharing dinov2 and SDXL, their phases interleaved
+# CUDA_VISIBLE_DEVICES=0 python main.py \
+#     --config_file config/tco_fox.yaml config/tco_mink.yaml config/tco_student.yaml config/tco_3d_cat.yaml config/tco_child.yaml \
+#     --policy fair_share
+# with `pool_queue_dir` set in the first config, the pools are rendered by workers on the other GPUs
+# CUDA_VISIBLE_DEVICES=1 python main.py --config_file config/tco_fox.yaml --worker
+
+# speed and clustering agreement of the draft pools (`draft_pool`) against full quality ones
+# CUDA_VISIBLE_DEVICES=0 python benchmark_draft.py --config_file config/tco_fox.yaml -r 3
@@ -0,0 +1,45 @@
+import hashlib
+import json
+import os
+
+from .image_io import write_json_atomic
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+ADAPTER_MANIFEST = "adapter.json"
+ADAPTER_FORMAT = 1
+
+
+def base_fingerprint(model_name, vae_name, unet_config, vae_config):
+    """Short hash of the base model an adapter belongs to: its names and the configs of its UNet and VAE."""
+    def _public(config):
+        # private keys hold the local paths the models were loaded from
+        return {k: v for k, v in dict(config).items() if not k.startswith("_")}
+
+    base = json.dumps([model_name, vae_name, _public(unet_config), _public(vae_config)], sort_keys=True, default=str)
+    return hashlib.sha256(base.encode()).hexdigest()[:16]
+
+
+def save_adapter_manifest(adapter_dir, fingerprint, **manifest):
+    """Write the manifest of a loop artifact: the names of its weight files, its tokens and the base fingerprint."""
+    manifest = {"format": ADAPTER_FORMAT, "base_fingerprint": fingerprint, **manifest}
+    write_json_atomic(os.path.join(adapter_dir, ADAPTER_MANIFEST), manifest, indent=2)
+
+
+def load_adapter_manifest(adapter_dir, fingerprint=None):
+    """Read the manifest of a loop artifact, None if the directory has none (a full pipeline or bare weights).
+
+    Raises a ValueError if `fingerprint` is given and the adapter was trained on another base model.
+    """
+    path = os.path.join(adapter_dir, ADAPTER_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if fingerprint is not None and manifest["base_fingerprint"] != fingerprint:
+        raise ValueError(f"The adapter '{adapter_dir}' was trained on another base model "
+                         f"(fingerprint {manifest['base_fingerprint']}, the base is {fingerprint}).")
+    return manifest
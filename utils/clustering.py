@@ -0,0 +1,142 @@
+import time
+
+import numpy as np
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+KMEANS_BACKENDS = ('sklearn', 'minibatch', 'torch')
+
+
+def _sklearn_kmeans(x, n_clusters, seed, n_init, max_iter, minibatch, batch_size):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+
+    if minibatch:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, init='k-means++', random_state=seed, n_init=n_init,
+                                 max_iter=max_iter, batch_size=batch_size)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, init='k-means++', random_state=seed, n_init=n_init, max_iter=max_iter)
+    kmeans.fit(x)
+    return kmeans.cluster_centers_, kmeans.labels_, kmeans.inertia_
+
+
+def _torch_assign(x, centers, chunk_size):
+    """Nearest center of every point for each restart, `centers` of shape (R, K, D)."""
+    import torch
+
+    labels, min_d2 = [], []
+    c_sq = (centers * centers).sum(-1)
+    for i in range(0, len(x), chunk_size):
+        xc = x[i:i + chunk_size]
+        # (R, n, K) squared distances
+        d2 = (xc * xc).sum(-1)[None, :, None] + c_sq[:, None, :] - 2 * torch.matmul(xc, centers.transpose(1, 2))
+        d, l = d2.clamp_min_(0).min(-1)
+        labels.append(l)
+        min_d2.append(d)
+    return torch.cat(labels, dim=1), torch.cat(min_d2, dim=1)
+
+
+def _torch_kmeans(x, n_clusters, seed, n_init, max_iter, device, tol=1e-4, chunk_size=4096):
+    """Lloyd's k-means with k-means++ init, the `n_init` restarts run side by side as a batch dimension."""
+    import torch
+
+    gen = torch.Generator(device='cpu').manual_seed(seed)
+    x = torch.as_tensor(np.ascontiguousarray(x), dtype=torch.float32).to(device)
+    n, dim = x.shape
+
+    # greedy k-means++ seeding (as in sklearn) for all restarts at once
+    centers = torch.empty((n_init, n_clusters, dim), device=device)
+    first = torch.randint(n, (n_init,), generator=gen).to(device)
+    centers[:, 0] = x[first]
+    x_sq = (x * x).sum(-1)
+    n_trials = 2 + int(np.log(n_clusters))
+
+    def _d2_to(c):
+        # (..., N) squared distances to the (..., D) centers
+        return (x_sq + (c * c).sum(-1)[..., None] - 2 * c @ x.T).clamp_min_(0)
+
+    min_d2 = _d2_to(centers[:, 0])
+    for k in range(1, n_clusters):
+        probs = min_d2.clamp_min(1e-12).cpu()
+        candidates = torch.multinomial(probs, n_trials, replacement=True, generator=gen).to(device)
+        # keep the candidate lowering the potential the most
+        cand_d2 = torch.minimum(min_d2[:, None], _d2_to(x[candidates]))
+        best = cand_d2.sum(-1).argmin(-1)
+        centers[:, k] = x[candidates.gather(1, best[:, None]).squeeze(1)]
+        min_d2 = cand_d2[torch.arange(n_init, device=device), best]
+
+    for _ in range(max_iter):
+        labels, _ = _torch_assign(x, centers, chunk_size)
+        sums = torch.zeros((n_init, n_clusters, dim), device=device)
+        for r in range(n_init):
+            sums[r].index_add_(0, labels[r], x)
+        counts = torch.stack([torch.bincount(l, minlength=n_clusters) for l in labels]).to(x.dtype)[..., None]
+        # empty clusters keep their center
+        new_centers = torch.where(counts > 0, sums / counts.clamp_min(1), centers)
+        shift = ((new_centers - centers) ** 2).sum((1, 2)).max()
+        centers = new_centers
+        if shift <= tol:
+            break
+
+    labels, min_d2 = _torch_assign(x, centers, chunk_size)
+    inertia = min_d2.double().sum(-1)
+    best = int(inertia.argmin())
+    return centers[best].cpu().numpy(), labels[best].cpu().numpy(), float(inertia[best])
+
+
+def fit_kmeans(x, n_clusters, backend='sklearn', n_init=1, seed=42, max_iter=300, device='cpu',
+               batch_size=1024):
+    """Run k-means on (N, D) points with the given backend.
+
+    Backends:
+        'sklearn': sklearn `KMeans` with k-means++ init.
+        'minibatch': sklearn `MiniBatchKMeans`, for pools of tens of thousands of points.
+        'torch': Lloyd's algorithm in torch, on CPU threads or an accelerator (`device`).
+
+    The sklearn backends run the `n_init` restarts one after the other, each on all the OpenMP
+    threads (restarts in parallel threads would oversubscribe the CPU), the torch backend runs them
+    side by side as a batch dimension. The restart with the lowest inertia wins.
+
+    Returns:
+        (centers, labels, inertia)
+    """
+    x = np.asarray(x, dtype=np.float32)
+    n_init = max(1, int(n_init))
+    if backend == 'torch':
+        return _torch_kmeans(x, n_clusters, seed, n_init, max_iter, device)
+    if backend not in KMEANS_BACKENDS:
+        raise ValueError(f'Invalid k-means backend: "{backend}", choose from {KMEANS_BACKENDS}')
+
+    return _sklearn_kmeans(x, n_clusters, seed, n_init, max_iter, backend == 'minibatch', batch_size)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the k-means backends against the sklearn path.")
+    parser.add_argument('-n', '--num_points', type=int, action='append', help='Pool sizes, default 128, 2000 and 20000.')
+    parser.add_argument('-d', '--dim', type=int, default=1024)
+    parser.add_argument('-k', '--points_per_cluster', type=int, default=20)
+    parser.add_argument('--n_init', type=int, default=4)
+    parser.add_argument('--device', type=str, default='cpu')
+    bench_args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for n in bench_args.num_points or [128, 2000, 20000]:
+        k = max(2, n // bench_args.points_per_cluster)
+        # blobs around random centers, roughly like DINOv2 embeddings of a pool
+        truth = rng.normal(size=(k, bench_args.dim)) * 2
+        x = (truth[rng.integers(k, size=n)] + rng.normal(size=(n, bench_args.dim))).astype(np.float32)
+
+        results = {}
+        for backend in KMEANS_BACKENDS:
+            start = time.perf_counter()
+            _, _, inertia = fit_kmeans(x, k, backend=backend, n_init=bench_args.n_init, device=bench_args.device)
+            results[backend] = (time.perf_counter() - start, inertia)
+        ref_time, ref_inertia = results['sklearn']
+        for backend, (wall, inertia) in results.items():
+            log.info((f"N={n:6d} K={k:4d} {backend:>9}: {wall:7.2f}s ({ref_time / wall:5.1f}x), "
+                      f"inertia {inertia:.4e} ({inertia / ref_inertia:.4f} of sklearn)"))
@@ -0,0 +1,186 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def _numpy_block_sum(x, block_size):
+    sq_norms = np.einsum('ij,ij->i', x, x)
+    total = 0.0
+    for i in range(0, len(x), block_size):
+        a, a_sq = x[i:i + block_size], sq_norms[i:i + block_size]
+        # upper triangle of blocks only, the off-diagonal ones count twice
+        for j in range(i, len(x), block_size):
+            b, b_sq = x[j:j + block_size], sq_norms[j:j + block_size]
+            d2 = a_sq[:, None] + b_sq[None, :] - 2.0 * (a @ b.T)
+            d = np.sqrt(np.maximum(d2, 0.0))
+            if i == j:
+                np.fill_diagonal(d, 0.0)
+                total += d.sum()
+            else:
+                total += 2.0 * d.sum()
+    return total
+
+
+def _torch_block_sum(x, block_size, device, dtype):
+    import torch
+
+    x = torch.as_tensor(x).to(device=device, dtype=dtype)
+    total = torch.zeros((), device=x.device, dtype=torch.float64)
+    for i in range(0, len(x), block_size):
+        a = x[i:i + block_size]
+        for j in range(i, len(x), block_size):
+            d = torch.cdist(a, x[j:j + block_size], compute_mode='donot_use_mm_for_euclid_dist')
+            if i == j:
+                d.fill_diagonal_(0.0)
+            total += d.sum(dtype=torch.float64) * (1.0 if i == j else 2.0)
+    return total.item()
+
+
+def mean_pairwise_distance(embeddings, block_size=1024, backend="numpy", device="cpu", dtype=None):
+    """Mean euclidean distance over all (i, j) pairs, equal to `np.mean(cdist(x, x))`.
+
+    The distance matrix is computed in (block_size, block_size) tiles and only the upper
+    triangle of tiles is visited, so memory is bounded by one tile instead of N x N.
+
+    Args:
+        embeddings (array): (N, D) vectors.
+        block_size (int): Side of a tile.
+        backend (str): 'numpy', or 'torch' to run on `device` (e.g. 'cuda').
+        device (str): Device of the torch backend.
+        dtype: Computation dtype, float64 by default.
+    """
+    n = len(embeddings)
+    if n == 0:
+        return 0.0
+    x = np.asarray(embeddings).reshape(n, -1)
+    if backend == "numpy":
+        total = _numpy_block_sum(x.astype(dtype or np.float64, copy=False), block_size)
+    elif backend == "torch":
+        import torch
+        total = _torch_block_sum(x, block_size, device, dtype or torch.float64)
+    else:
+        raise ValueError(f'Invalid distance backend: "{backend}"')
+    return total / (n * n)
+
+
+def estimate_mean_pairwise_distance(embeddings, num_pairs=100000, seed=0):
+    """Unbiased random-pair estimate of `mean_pairwise_distance`, for very large pools.
+
+    Pairs (i, j) with i != j are drawn uniformly, the mean is rescaled by (N - 1) / N
+    to account for the zero diagonal of the full matrix.
+
+    Returns:
+        (float, float): The estimate and its standard error.
+    """
+    x = np.asarray(embeddings).reshape(len(embeddings), -1)
+    n = len(x)
+    if n < 2:
+        return 0.0, 0.0
+    rng = np.random.default_rng(seed)
+    i = rng.integers(0, n, size=num_pairs)
+    # shift by 1..n-1 so that j never equals i
+    j = (i + rng.integers(1, n, size=num_pairs)) % n
+    d = np.linalg.norm(x[i].astype(np.float64) - x[j], axis=-1)
+    scale = (n - 1) / n
+    return scale * d.mean(), scale * d.std(ddof=1) / np.sqrt(num_pairs)
+
+
+def pool_distance(embeddings, backend="numpy", device="cpu", block_size=1024, num_pairs=0, seed=0):
+    """Mean pairwise distance of a pool, exact by default, estimated from `num_pairs` random pairs if > 0."""
+    if num_pairs > 0:
+        dist, std_err = estimate_mean_pairwise_distance(embeddings, num_pairs=num_pairs, seed=seed)
+        log.info(f"Estimated mean pairwise distance from {num_pairs} pairs: {dist:.4f} (+/- {std_err:.4f}).")
+        return dist
+    return mean_pairwise_distance(embeddings, block_size=block_size, backend=backend, device=device)
+
+
+class SequentialConvergenceTest:
+    """Streaming estimate of the mean pairwise distance of a pool, tested against a threshold.
+
+    Embeddings are added one at a time as the pool is generated. The distances between
+    the first n images give an unbiased estimate (a U-statistic) of the mean distance of
+    two images, whose variance follows the Hoeffding decomposition (spread of the per-image
+    mean distances, plus the spread of the distances themselves), with a finite population
+    correction for the `pool_size` images to come.
+    Once the `confidence` bound on the mean distance of the whole pool is entirely below
+    `threshold` the pool has converged, once it is entirely above it has not.
+    The bound is only checked at a few sample sizes, growing by `look_growth` from `min_samples`,
+    and the error rate is split evenly between these checks (Bonferroni), so that `confidence`
+    holds for the whole sequence. The first images of a clustered pool may miss a small
+    cluster altogether, which no bound on them accounts for: `min_samples` keeps it unlikely.
+
+    Args:
+        threshold (float): Convergence threshold on the mean pairwise distance (cdist mean).
+        pool_size (int): Number of images of the full pool.
+        confidence (float): Two-sided confidence of the bound, over all the checks.
+        min_samples (int): Number of images before the first decision.
+        look_growth (float): Ratio between the sample sizes of two checks.
+    """
+    def __init__(self, threshold, pool_size, confidence=0.99, min_samples=64, look_growth=1.25):
+        self.threshold = threshold
+        self.pool_size = pool_size
+        self.min_samples = max(3, min_samples)
+        self.looks = []
+        n = float(self.min_samples)
+        while n < pool_size:
+            if round(n) not in self.looks:
+                self.looks.append(round(n))
+            n *= look_growth
+        self.z = NormalDist().inv_cdf(1 - (1 - confidence) / 2 / max(1, len(self.looks)))
+        self.decision = None
+        self.decided_at = None
+        self._embs = []
+        self._row_sums = np.zeros(0)
+        self._pair_sum = 0.0
+        self._pair_sq_sum = 0.0
+
+    @property
+    def num_samples(self):
+        return len(self._embs)
+
+    def update(self, emb):
+        """Add one embedding, return the decision: None, 'converged' or 'not_converged'."""
+        emb = np.asarray(emb, dtype=np.float64).reshape(-1)
+        d = np.linalg.norm(np.stack(self._embs) - emb, axis=-1) if self._embs else np.zeros(0)
+        self._row_sums = np.append(self._row_sums + d, d.sum())
+        self._pair_sum += d.sum()
+        self._pair_sq_sum += (d * d).sum()
+        self._embs.append(emb)
+
+        if self.decision is None and self.num_samples in self.looks:
+            low, high = self.bounds()
+            if high < self.threshold:
+                self.decision = 'converged'
+            elif low > self.threshold:
+                self.decision = 'not_converged'
+            if self.decision is not None:
+                self.decided_at = self.num_samples
+        return self.decision
+
+    def estimate(self):
+        """Estimated mean pairwise distance of the full pool, with the zero diagonal like `np.mean(cdist)`."""
+        n = self.num_samples
+        if n < 2:
+            return 0.0
+        pair_mean = self._pair_sum / (n * (n - 1) / 2)
+        return pair_mean * (self.pool_size - 1) / self.pool_size
+
+    def bounds(self):
+        n = self.num_samples
+        est = self.estimate()
+        if n < 3:
+            return -np.inf, np.inf
+        num_pairs = n * (n - 1) / 2
+        pair_mean = self._pair_sum / num_pairs
+        pair_var = max(0.0, self._pair_sq_sum / num_pairs - pair_mean ** 2)
+        per_image_var = (self._row_sums / (n - 1)).var(ddof=1)
+        fpc = max(0.0, 1 - n / self.pool_size)
+        var = (4 * per_image_var / n + 2 * pair_var / (n * (n - 1))) * fpc
+        std_err = np.sqrt(var) * (self.pool_size - 1) / self.pool_size
+        return est - self.z * std_err, est + self.z * std_err
+
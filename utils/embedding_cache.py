@@ -0,0 +1,125 @@
+import glob
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+
+from .image_io import write_json_atomic
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """sha256 of the file content, as hex string."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat_key(path):
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_size, st.st_mtime_ns
+
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by the image content hash and the extractor identity.
+
+    Every saved group (one pool directory) is stored as a single float32 `.npy` array,
+    memory-mapped when read back, next to a small json index holding the content hash
+    and the (path, size, mtime) of every row. Every save writes a new array under a unique
+    name, referenced by the index, so the index (replaced last) never pairs with another array. The file is only hashed again when its
+    (path, size, mtime) does not match the index, so a warm lookup never reads the images.
+
+    Args:
+        cache_dir (str): Directory of the cache files, shared by all the groups.
+        extractor_id (str): Identity of the feature extractor (model and preprocessing),
+            embeddings of other extractors in the same directory are ignored.
+    """
+    def __init__(self, cache_dir, extractor_id):
+        self.cache_dir = cache_dir
+        self.extractor_id = extractor_id
+        self._tag = hashlib.sha1(extractor_id.encode()).hexdigest()[:8]
+        os.makedirs(cache_dir, exist_ok=True)
+        # digest -> (memmap, row), (abs path, size, mtime) -> digest
+        self._rows = None
+        self._stats = None
+
+    def _group_paths(self, name):
+        stem = os.path.join(self.cache_dir, f"{name}.{self._tag}")
+        return f"{stem}.{uuid.uuid4().hex}.npy", f"{stem}.json"
+
+    def _load_indices(self):
+        self._rows, self._stats = {}, {}
+        for index_path in sorted(glob.glob(os.path.join(self.cache_dir, f"*.{self._tag}.json"))):
+            try:
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+                if index["extractor"] != self.extractor_id:
+                    continue
+                embs = np.load(os.path.join(self.cache_dir, index["array"]), mmap_mode='r')
+                if embs.shape != (len(index["rows"]), index["dim"]):
+                    raise ValueError(f"array of shape {embs.shape} for {len(index['rows'])} rows of {index['dim']}")
+            except (OSError, ValueError, KeyError) as err:
+                log.warning(f"Ignored broken embedding cache group '{index_path}': {err}")
+                continue
+            self._add_rows(index["rows"], embs)
+
+    def _add_rows(self, rows, embs):
+        for row_id, row in enumerate(rows):
+            self._rows[row["sha256"]] = (embs, row_id)
+            self._stats[(row["path"], row["size"], row["mtime_ns"])] = row["sha256"]
+
+    def digest(self, path):
+        if self._stats is None:
+            self._load_indices()
+        key = _stat_key(path)
+        if key in self._stats:
+            return self._stats[key]
+        return file_digest(path)
+
+    def lookup(self, paths):
+        """Return `(digests, embeddings)` of the image files, with None for every cache miss."""
+        if self._rows is None:
+            self._load_indices()
+        digests = [self.digest(p) for p in paths]
+        embs = []
+        for d in digests:
+            hit = self._rows.get(d)
+            embs.append(None if hit is None else np.array(hit[0][hit[1]]))
+        return digests, embs
+
+    def save(self, name, paths, embeddings, digests=None):
+        """Write the (N, D) embeddings of the image files as the group `name`, replacing the old one."""
+        if self._rows is None:
+            self._load_indices()
+        if digests is None:
+            digests = [file_digest(p) for p in paths]
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32).reshape(len(paths), -1)
+        rows = []
+        for path, d in zip(paths, digests):
+            abs_path, size, mtime_ns = _stat_key(path)
+            rows.append({"sha256": d, "path": abs_path, "size": size, "mtime_ns": mtime_ns})
+
+        npy_path, index_path = self._group_paths(name)
+        # a new array, only referenced once the index is replaced: a crash leaves the previous group whole
+        with open(npy_path, 'wb') as f:
+            np.save(f, embeddings)
+        write_json_atomic(index_path, {"extractor": self.extractor_id, "array": os.path.basename(npy_path),
+                                       "dim": embeddings.shape[-1], "rows": rows})
+        # the previous arrays of the group, the ones of interrupted saves, and the unversioned one of older caches
+        stem = os.path.join(self.cache_dir, f"{glob.escape(name)}.{self._tag}")
+        for old_path in glob.glob(f"{stem}.*.npy") + glob.glob(f"{stem}.npy"):
+            if old_path != npy_path:
+                try:
+                    os.remove(old_path)
+                except OSError as err:
+                    log.debug(f"Cannot remove the old embedding array '{old_path}': {err}")
+
+        self._add_rows(rows, np.load(npy_path, mmap_mode='r'))
+        log.info(f"Cached {len(rows)} embeddings to '{npy_path}'.")
@@ -0,0 +1,71 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+import torchvision.transforms as T
+from PIL import Image
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+class FeatureExtractor:
+    """Batched image feature extraction with a vision backbone (e.g. DINOv2).
+
+    Images are decoded (if given as paths), resized and normalized on a thread pool,
+    a bounded window ahead of the model, and go through the model in batches under
+    `torch.inference_mode`. The features stay on the device until the end, so the
+    device is synced once per call instead of once per image.
+
+    Args:
+        model: Backbone called as `model(x, is_training=False)`, returning (B, D) features.
+        input_size (int): Side of the square model input.
+        batch_size (int): Number of images per forward pass.
+        num_workers (int): Number of preprocessing threads.
+        device (str): Device of the model.
+    """
+    def __init__(self, model, input_size=518, batch_size=16, num_workers=4, device="cuda"):
+        self.model = model
+        self.batch_size = max(1, int(batch_size))
+        self.num_workers = max(1, int(num_workers))
+        self.device = device
+        self.transform = T.Compose([
+            T.Resize((input_size, input_size)),
+            T.ToTensor(),
+            T.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))
+        ])
+
+    def _preprocess(self, image):
+        if not isinstance(image, Image.Image):
+            with Image.open(image) as img:
+                image = img.convert('RGB')
+        elif image.mode != 'RGB':
+            image = image.convert('RGB')
+        return self.transform(image)
+
+    def __call__(self, images):
+        """
+        extract the features of a list of PIL images or image paths
+        return: features, in numpy of shape (N, D)
+        """
+        images = list(images)
+        if not images:
+            return np.zeros((0, 0), dtype=np.float32)
+
+        feats = []
+        with ThreadPoolExecutor(self.num_workers) as pool, torch.inference_mode():
+            # keep at most two batches in flight in the preprocessing threads
+            window = 2 * self.batch_size
+            pending = [pool.submit(self._preprocess, img) for img in images[:window]]
+            next_id = len(pending)
+            while pending:
+                batch, pending = pending[:self.batch_size], pending[self.batch_size:]
+                new_ids = range(next_id, min(next_id + len(batch), len(images)))
+                pending += [pool.submit(self._preprocess, images[i]) for i in new_ids]
+                next_id += len(new_ids)
+
+                x = torch.stack([f.result() for f in batch]).to(self.device, non_blocking=True)
+                feats.append(self.model(x, is_training=False).reshape(len(batch), -1))
+        return torch.cat(feats).float().cpu().numpy()
@@ -0,0 +1,166 @@
+import hashlib
+import os
+
+import torch
+from PIL import Image
+
+from .latent_cache import save_handoff_latents
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def derive_seed(loop_id, img_id, base_seed=0):
+    """Deterministic seed of a pool image, only depending on (base_seed, loop_id, img_id).
+
+    The seed does not depend on the generation order or the batch an image ends up in,
+    so resumed or re-batched runs render exactly the same pool.
+    """
+    digest = hashlib.sha256(f"{base_seed}-{loop_id}-{img_id}".encode()).digest()
+    return int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+
+
+def is_oom_error(err):
+    if isinstance(err, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(err, RuntimeError) and "out of memory" in str(err).lower()
+
+
+class AdaptiveBatchSize:
+    """Batch size controller for generation.
+
+    Halves the batch size on every out-of-memory error and doubles it again
+    (up to `max_size`) after `grow_after` consecutive successful batches.
+    """
+    def __init__(self, init_size=1, max_size=None, grow_after=4):
+        self.size = max(1, int(init_size))
+        self.max_size = max(self.size, int(max_size or self.size))
+        self.grow_after = grow_after
+        self._num_success = 0
+
+    def shrink(self):
+        if self.size == 1:
+            return False
+        failed_size = self.size
+        self.size = max(1, failed_size // 2)
+        # never grow back to the size that just failed
+        self.max_size = max(self.size, failed_size - 1)
+        self._num_success = 0
+        log.warning(f"OOM during generation, batch size shrunk to {self.size}.")
+        return True
+
+    def success(self):
+        self._num_success += 1
+        if self._num_success >= self.grow_after and self.size < self.max_size:
+            self.size = min(self.size * 2, self.max_size)
+            self._num_success = 0
+            log.info(f"Generation batch size grown to {self.size}.")
+
+
+def generate_images_batched(pipe, prompt, infer_steps, seeds, guidance_scale=7.5, device=None, return_latents=False,
+                            **pipe_kwargs):
+    """
+    render one image per seed in a single pipeline call, each with its own torch.Generator,
+    with `return_latents` the latents are decoded here, so that they are kept along the images,
+    as they are with a VAE in another dtype than the unet (e.g. the float32 VAE of a bfloat16 base pipeline)
+    return: list of images, in PIL (and the scaled latents, in a tensor of shape (N, C, H, W))
+    """
+    device = device or pipe.device
+    generators = [torch.Generator(device=device).manual_seed(seed) for seed in seeds]
+    vae_dtype_differs = getattr(pipe, "vae", None) is not None and pipe.vae.dtype != pipe.unet.dtype
+    if not return_latents and not vae_dtype_differs:
+        return pipe([prompt] * len(seeds),
+                    num_inference_steps=infer_steps,
+                    guidance_scale=guidance_scale,
+                    generator=generators,
+                    **pipe_kwargs).images
+
+    latents = pipe([prompt] * len(seeds),
+                   num_inference_steps=infer_steps,
+                   guidance_scale=guidance_scale,
+                   generator=generators,
+                   output_type="latent",
+                   **pipe_kwargs).images
+    # as the pipeline does, a VAE overflowing in half precision (`force_upcast`, e.g. the SDXL base one,
+    # not the fp16-fix one) decodes in float32, and is cast back afterwards
+    vae = pipe.vae
+    needs_upcasting = vae.dtype == torch.float16 and getattr(vae.config, "force_upcast", False)
+    if needs_upcasting:
+        vae.to(dtype=torch.float32)
+    try:
+        with torch.no_grad():
+            images = vae.decode(latents.to(vae.dtype) / vae.config.scaling_factor, return_dict=False)[0]
+    finally:
+        if needs_upcasting:
+            vae.to(dtype=torch.float16)
+    if getattr(pipe, "watermark", None) is not None:
+        images = pipe.watermark.apply_watermark(images)
+    images = pipe.image_processor.postprocess(images, output_type="pil")
+    return (images, latents) if return_latents else images
+
+
+def iter_pool_images(pipe, args, pool_dir, loop_id, batch_size=None, indices=None, lazy=False, infer_steps=None,
+                     resolution=None, latents_dir=None):
+    """Yield `(img_id, image, is_new)` for every slot of the pool directory, in index order.
+
+    Images already present in `pool_dir` are loaded instead of generated, missing ones
+    are rendered in batches whose size adapts to out-of-memory errors. New images are
+    NOT saved here, the caller decides how to persist them.
+
+    Args:
+        pipe: The diffusion pipeline, only touched if some images are missing.
+        args: Run configuration (`num_of_generated_img`, `inference_prompt`, `infer_steps`,
+            `seed`, `gen_batch_size`, `gen_max_batch_size`).
+        pool_dir (str): Directory of the pool PNGs of this loop.
+        loop_id (int): Current loop, part of the per-image seed.
+        batch_size (AdaptiveBatchSize): Optional controller shared across loops.
+        indices (iterable): Optional subset of image ids to go through.
+        lazy (bool): Yield the path of the images already in `pool_dir` instead of decoding them.
+        infer_steps (int): Denoising steps, `args.infer_steps` by default.
+        resolution (int): Side of the rendered images, the pipeline default if None.
+        latents_dir (str): Where to save the latents of the rendered images, for the training (see `LatentCache`).
+    """
+    if batch_size is None:
+        init_size = getattr(args, "gen_batch_size", 1)
+        batch_size = AdaptiveBatchSize(init_size, getattr(args, "gen_max_batch_size", init_size * 2))
+    if indices is None:
+        indices = range(args.num_of_generated_img)
+    base_seed = getattr(args, "seed", 0) or 0
+    infer_steps = infer_steps or args.infer_steps
+    pipe_kwargs = {} if resolution is None else dict(height=resolution, width=resolution)
+
+    def _flush(pending):
+        while pending:
+            batch = pending[:batch_size.size]
+            seeds = [derive_seed(loop_id, img_id, base_seed) for img_id in batch]
+            try:
+                images = generate_images_batched(pipe, args.inference_prompt, infer_steps, seeds,
+                                                 return_latents=latents_dir is not None, **pipe_kwargs)
+            except Exception as err:
+                if not is_oom_error(err):
+                    raise
+                torch.cuda.empty_cache()
+                if not batch_size.shrink():
+                    raise
+                continue
+            batch_size.success()
+            if latents_dir is not None:
+                images, latents = images
+                save_handoff_latents(latents_dir, batch, latents)
+            del pending[:len(batch)]
+            for img_id, image in zip(batch, images):
+                yield img_id, image, True
+
+    pending = []
+    for img_id in indices:
+        img_path = os.path.join(pool_dir, f"{img_id}.png")
+        if os.path.exists(img_path):
+            # keep the output in index order
+            yield from _flush(pending)
+            yield img_id, img_path if lazy else Image.open(img_path).convert('RGB'), False
+        else:
+            pending.append(img_id)
+            if len(pending) >= batch_size.size:
+                yield from _flush(pending)
+    yield from _flush(pending)
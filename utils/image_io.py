@@ -0,0 +1,160 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def write_atomic(path, write_fn):
+    """Write `path` with `write_fn(tmp_path)` into a hidden temp file next to it, renamed over `path`.
+
+    A crash in the middle of the write never leaves a partial file at `path`, the temp file is removed on errors.
+    """
+    dir_name, file_name = os.path.split(path)
+    tmp_path = os.path.join(dir_name, f".{file_name}.{uuid.uuid4().hex}.tmp")
+    try:
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_json_atomic(path, obj, **dump_kwargs):
+    """Dump `obj` as json into `path` with `write_atomic`."""
+    def _dump(tmp_path):
+        with open(tmp_path, 'w') as f:
+            json.dump(obj, f, **dump_kwargs)
+    write_atomic(path, _dump)
+
+
+def save_image_atomic(image, path, **save_kwargs):
+    """Save a PIL image through a temp file renamed over `path`.
+
+    The temp file is hidden and does not carry the image extension, so a crash in the
+    middle of the encoding never leaves a partial image that the resume checks would trust.
+    """
+    fmt = Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+    write_atomic(path, lambda tmp_path: image.save(tmp_path, format=fmt, **save_kwargs))
+
+
+def copy_file_atomic(src, dst):
+    """Copy a file through a hidden temp file renamed over `dst`."""
+    write_atomic(dst, lambda tmp_path: shutil.copyfile(src, tmp_path))
+
+
+MATERIALIZE_MODES = ('copy', 'hardlink', 'symlink', 'manifest')
+MANIFEST_NAME = "manifest.txt"
+
+
+def link_or_copy(src, dst, mode='hardlink'):
+    """Make `dst` a hard link, a symlink or a copy of `src`, replacing it atomically.
+
+    Hard links fall back to a copy when the two paths are on different filesystems
+    (or the filesystem has no hard links).
+    """
+    if mode == 'copy':
+        return copy_file_atomic(src, dst)
+    if mode == 'hardlink':
+        link_fn = lambda tmp_path: os.link(src, tmp_path)
+    elif mode == 'symlink':
+        link_fn = lambda tmp_path: os.symlink(os.path.abspath(src), tmp_path)
+    else:
+        raise ValueError(f'Invalid link mode: "{mode}"')
+    try:
+        write_atomic(dst, link_fn)
+    except OSError as err:
+        log.debug(f"Cannot {mode} '{src}' ({err}), copying it.")
+        return copy_file_atomic(src, dst)
+
+
+def write_manifest(data_dir, paths):
+    """Write the list of image paths a training directory stands for, instead of the images."""
+    with open(os.path.join(data_dir, MANIFEST_NAME), 'w') as f:
+        f.write("".join(f"{os.path.abspath(p)}\n" for p in paths))
+
+
+def list_images(data_dir):
+    """Image paths of a training directory, read from its manifest if it has one."""
+    manifest_path = os.path.join(data_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    # hidden files are temp files of unfinished writes
+    return [os.path.join(data_dir, name) for name in sorted(os.listdir(data_dir)) if not name.startswith('.')]
+
+
+class ImageWriter:
+    """Background image writer backed by a thread pool.
+
+    `save` returns as soon as the image is queued, PNG encoding runs in the worker threads
+    (zlib releases the GIL). At most `max_in_flight` images are queued or being written,
+    further calls block. `flush` is the barrier to call before anything reads the written
+    directories, it also re-raises the first failed write.
+
+    Args:
+        num_workers (int): Number of writer threads.
+        max_in_flight (int): Maximum number of pending images.
+    """
+    def __init__(self, num_workers=4, max_in_flight=32):
+        self.max_in_flight = max(1, int(max_in_flight))
+        self._pool = ThreadPoolExecutor(max(1, int(num_workers)), thread_name_prefix="image-writer")
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._futures = []
+        self.num_written = 0
+        self.write_time = 0.0
+        self.blocked_time = 0.0
+
+    def _write(self, write_fn, *write_args, **write_kwargs):
+        start = time.perf_counter()
+        try:
+            write_fn(*write_args, **write_kwargs)
+        finally:
+            with self._lock:
+                self.num_written += 1
+                self.write_time += time.perf_counter() - start
+            self._slots.release()
+
+    def _submit(self, write_fn, *write_args, **write_kwargs):
+        start = time.perf_counter()
+        self._slots.acquire()
+        self.blocked_time += time.perf_counter() - start
+        future = self._pool.submit(self._write, write_fn, *write_args, **write_kwargs)
+        with self._lock:
+            self._futures.append(future)
+        return future
+
+    def save(self, image, path, **save_kwargs):
+        return self._submit(save_image_atomic, image, path, **save_kwargs)
+
+    def copy(self, src, dst, mode='copy'):
+        """Copy (or link, see `link_or_copy`) an already encoded image file, with the same guarantees as `save`."""
+        return self._submit(link_or_copy, src, dst, mode)
+
+    def flush(self):
+        """Wait for every queued image to be written."""
+        with self._lock:
+            futures, self._futures = self._futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+
+    def summary(self):
+        return (f"image writer: {self.num_written} images, writing {self.write_time:.1f}s (summed over workers), "
+                f"callers blocked {self.blocked_time:.1f}s")
@@ -0,0 +1,98 @@
+import json
+import os
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .image_io import write_atomic, write_json_atomic
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+class ImageStore:
+    """Training images decoded and resized once, in a uint8 memory-mapped array.
+
+    The images are stored one after the other, flattened (HWC), in a `.npy` file read through
+    a memory map, so that every loader worker shares the decoded pixels through the page cache
+    instead of opening and decoding the image files at every sample. An index next to it holds
+    the shape and original size of every image and the key of the data, a store with another
+    key is rebuilt. Crops and flips are then cheap array slices of the stored pixels.
+
+    Args:
+        path (str): Path of the `.npy` array, the index is `<path>.json`.
+        index (dict): Key, and offset, shape and original size of every image.
+    """
+    def __init__(self, path, index):
+        self.path = path
+        self.index = index
+        self._array = None
+
+    def __len__(self):
+        return len(self.index["images"])
+
+    def __getstate__(self):
+        # the loader workers open their own memory map
+        state = self.__dict__.copy()
+        state["_array"] = None
+        return state
+
+    def original_size(self, i):
+        return tuple(self.index["images"][i]["original_size"])
+
+    def image(self, i):
+        """The resized image `i`, a read-only uint8 array of shape (H, W, 3) in the memory map."""
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode='r')
+        entry = self.index["images"][i]
+        size = int(np.prod(entry["shape"]))
+        return self._array[entry["offset"] : entry["offset"] + size].reshape(entry["shape"])
+
+    def crop(self, i, top, left, height, width, flip=False):
+        """A crop of the image `i`, optionally flipped, as a uint8 tensor of shape (3, height, width)."""
+        pixels = self.image(i)[top : top + height, left : left + width]
+        if flip:
+            pixels = pixels[:, ::-1]
+        return torch.from_numpy(np.ascontiguousarray(pixels)).permute(2, 0, 1)
+
+    @classmethod
+    def build(cls, image_paths, resize, path, key=None):
+        """Decode and `resize` (PIL to PIL) every image of `image_paths` into `path`, or open it if its key matches."""
+        index_path = f"{path}.json"
+        # the key as read back from json
+        key = json.loads(json.dumps(key))
+        if os.path.exists(path) and os.path.exists(index_path):
+            with open(index_path, 'r') as f:
+                index = json.load(f)
+            if index["key"] == key:
+                log.info(f"Opened the store of {len(index['images'])} decoded training images '{path}'.")
+                return cls(path, index)
+
+        start = time.perf_counter()
+        images, entries, offset = [], [], 0
+        for image_path in image_paths:
+            image = Image.open(image_path)
+            if not image.mode == "RGB":
+                image = image.convert("RGB")
+            original_size = (image.height, image.width)
+            pixels = np.asarray(resize(image), dtype=np.uint8)
+            entries.append({"offset": offset, "shape": list(pixels.shape), "original_size": list(original_size)})
+            images.append(pixels.reshape(-1))
+            offset += pixels.size
+
+        def _write_array(tmp_path):
+            array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=(offset,))
+            for entry, pixels in zip(entries, images):
+                array[entry["offset"] : entry["offset"] + pixels.size] = pixels
+            array.flush()
+            del array
+
+        write_atomic(path, _write_array)
+        index = {"key": key, "images": entries}
+        write_json_atomic(index_path, index)
+        log.info(f"Decoded {len(entries)} training images into '{path}' ({offset / 2**20:.0f} MiB) "
+                 f"in {time.perf_counter() - start:.1f}s.")
+        return cls(path, index)
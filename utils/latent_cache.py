@@ -0,0 +1,109 @@
+import os
+import random
+import time
+
+import numpy as np
+import torch
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+# log-variance of the handed over latents, a distribution without spread
+HANDOFF_LOGVAR = -30.0
+
+
+def sample_latents(params):
+    """Sample latents from VAE latent distribution parameters (B, 2C, H, W), as `DiagonalGaussianDistribution.sample`."""
+    mean, logvar = params.chunk(2, dim=1)
+    std = torch.exp(0.5 * logvar.clamp(-30.0, 20.0))
+    return mean + std * torch.randn_like(mean)
+
+
+def handoff_params(latents, scaling_factor):
+    """Latent distribution parameters of the (scaled) latents rendered by the diffusion pipeline."""
+    mean = torch.as_tensor(latents, dtype=torch.float32) / scaling_factor
+    return torch.cat([mean, torch.full_like(mean, HANDOFF_LOGVAR)], dim=0)
+
+
+def save_handoff_latents(latents_dir, img_ids, latents):
+    """Save the latents of freshly rendered pool images, one `<img_id>.npy` per image."""
+    os.makedirs(latents_dir, exist_ok=True)
+    for img_id, latent in zip(img_ids, latents):
+        np.save(os.path.join(latents_dir, f"{img_id}.npy"), latent.float().cpu().numpy().astype(np.float16))
+
+
+class LatentCache:
+    """VAE latent distributions of every variant (crop and flip) of the training images.
+
+    Every variant is encoded once, and the training step only samples from its cached
+    distribution instead of running the VAE encoder. The latents of the unflipped images
+    can be handed over from the pool generation (`latents_dir`), the flipped variant then
+    is the mirrored latent, which is close to, but not exactly, the latent of the mirrored image.
+
+    With random crops, the `num_crops` cached crops are the only ones a loop trains on, instead
+    of a new crop at every step: less augmentation for fewer encodings. A center crop loses nothing.
+
+    Args:
+        variants (list): For every image, a list of (params, original_size, crop_top_left).
+        key (dict): Identity of the cached data (images, transforms, VAE and handed over latents).
+    """
+    def __init__(self, variants, key=None):
+        self.variants = variants
+        self.key = key
+
+    def __len__(self):
+        return len(self.variants)
+
+    def sample(self, i):
+        """A random variant of the image `i`: latent distribution parameters, original size and crop top left."""
+        return random.choice(self.variants[i])
+
+    @classmethod
+    def build(cls, dataset, vae, num_crops=1, batch_size=4, latents_dir=None, cache_path=None, key=None):
+        """Encode every variant of the images of `dataset`, or load them from `cache_path` if its key matches."""
+        if cache_path is not None and os.path.exists(cache_path):
+            cached = torch.load(cache_path)
+            if cached["key"] == key:
+                log.info(f"Loaded the latents of {len(cached['variants'])} training images from '{cache_path}'.")
+                return cls(cached["variants"], key)
+
+        start = time.perf_counter()
+        variants = [[] for _ in range(dataset.num_images)]
+        pending, num_encoded, num_handed_over = [], 0, 0
+
+        def _encode():
+            nonlocal num_encoded
+            pixel_values = torch.stack([pixels for _, pixels, _, _ in pending]).to(vae.device, dtype=vae.dtype)
+            with torch.no_grad():
+                params = vae.encode(pixel_values).latent_dist.parameters.float().cpu()
+            for (i, _, original_size, crop_top_left), p in zip(pending, params):
+                variants[i].append((p, original_size, crop_top_left))
+            num_encoded += len(pending)
+            pending.clear()
+
+        for i in range(dataset.num_images):
+            handoff = None
+            if latents_dir is not None:
+                handoff = os.path.join(latents_dir, os.path.splitext(os.path.basename(dataset.image_paths[i]))[0] + ".npy")
+            for pixels, original_size, crop_top_left, flipped in dataset.image_variants(i, num_crops=num_crops):
+                # the rendered latents only match the images taken as a whole
+                if handoff is not None and os.path.exists(handoff) and original_size == tuple(pixels.shape[1:]):
+                    params = handoff_params(np.load(handoff), vae.config.scaling_factor)
+                    variants[i].append((params.flip(-1) if flipped else params, original_size, crop_top_left))
+                    num_handed_over += 1
+                    continue
+                pending.append((i, pixels, original_size, crop_top_left))
+                if len(pending) >= batch_size:
+                    _encode()
+        if pending:
+            _encode()
+        log.info((f"Latent cache of {dataset.num_images} training images: {num_encoded} variants encoded, "
+                  f"{num_handed_over} handed over from the generation, in {time.perf_counter() - start:.1f}s."))
+
+        cache = cls(variants, key)
+        if cache_path is not None:
+            torch.save({"key": key, "variants": variants}, cache_path)
+        return cache
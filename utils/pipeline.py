@@ -0,0 +1,107 @@
+import queue
+import threading
+import time
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+_DONE = object()
+
+
+class PipelineStage:
+    """A worker thread applying `fn` to the items of a bounded input queue.
+
+    Items are handed to `fn` as lists of up to `batch_size` items, in the order they
+    were put. With `flush_timeout`, a partial batch is handed over once no item came for
+    that long, so a stage fed slower than it runs never sits on its items. `put` blocks while the queue is full, so a slow stage pushes back on its
+    producer instead of buffering without bound. The stage records how long it was busy,
+    how long it waited for input and how long its producers were blocked on it.
+
+    Args:
+        name (str): Name of the stage in the logs.
+        fn (callable): Called with a list of items.
+        maxsize (int): Capacity of the input queue.
+        batch_size (int): Maximum number of items per call of `fn`.
+        flush_timeout (float): Seconds without input after which a partial batch is processed,
+            None to always wait for a full batch (or the end of the input).
+    """
+    def __init__(self, name, fn, maxsize=8, batch_size=1, flush_timeout=None):
+        self.name = name
+        self.fn = fn
+        self.batch_size = max(1, int(batch_size))
+        self.flush_timeout = flush_timeout
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize)
+        self.num_items = 0
+        self.busy_time = 0.0
+        self.wait_time = 0.0
+        self.blocked_time = 0.0
+        self._depth_sum = 0
+        self._num_puts = 0
+        self._error = None
+        self._start = time.perf_counter()
+        self._end = None
+        self._thread = threading.Thread(target=self._run, name=f"stage-{name}", daemon=True)
+        self._thread.start()
+
+    def _check(self):
+        if self._error is not None:
+            raise RuntimeError(f"Pipeline stage '{self.name}' failed.") from self._error
+
+    def put(self, item):
+        self._check()
+        self._depth_sum += self.queue.qsize()
+        self._num_puts += 1
+        start = time.perf_counter()
+        self.queue.put(item)
+        self.blocked_time += time.perf_counter() - start
+
+    def _process(self, batch):
+        if self._error is not None:
+            # keep draining the queue after a failure, so that producers never block forever
+            return
+        start = time.perf_counter()
+        try:
+            self.fn(batch)
+        except BaseException as err:
+            self._error = err
+        self.busy_time += time.perf_counter() - start
+        self.num_items += len(batch)
+
+    def _run(self):
+        batch = []
+        while True:
+            start = time.perf_counter()
+            try:
+                item = self.queue.get(timeout=self.flush_timeout if batch else None)
+            except queue.Empty:
+                self.wait_time += time.perf_counter() - start
+                self._process(batch)
+                batch = []
+                continue
+            self.wait_time += time.perf_counter() - start
+            if item is _DONE:
+                break
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                self._process(batch)
+                batch = []
+        if batch:
+            self._process(batch)
+        self._end = time.perf_counter()
+
+    def join(self):
+        """Wait until every item put so far is processed, re-raising the error of the stage if any."""
+        self.queue.put(_DONE)
+        self._thread.join()
+        self._check()
+
+    def summary(self):
+        wall = max((self._end or time.perf_counter()) - self._start, 1e-9)
+        mean_depth = self._depth_sum / max(self._num_puts, 1)
+        return (f"stage '{self.name}': {self.num_items} items, busy {self.busy_time:.1f}s ({100 * self.busy_time / wall:.0f}%), "
+                f"starved {self.wait_time:.1f}s ({100 * self.wait_time / wall:.0f}%), "
+                f"queue {mean_depth:.1f}/{self.maxsize}, producers blocked {self.blocked_time:.1f}s")
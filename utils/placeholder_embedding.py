@@ -0,0 +1,47 @@
+import torch
+
+
+class PlaceholderEmbedding(torch.nn.Module):
+    """Token embedding of a text encoder whose only trainable weights are the placeholder rows.
+
+    Spliced in with `text_encoder.set_input_embeddings`, it looks the tokens up in the frozen
+    embedding and replaces the placeholder tokens by its own rows, kept in float32. The optimizer
+    state and the gradients then scale with the number of placeholder tokens instead of the
+    vocabulary, and the other rows never change, so there is nothing to restore after a step.
+    `weight` is the full embedding matrix with the learned rows, as the one of `torch.nn.Embedding`.
+
+    Args:
+        embedding (torch.nn.Embedding): Token embedding of the text encoder, with the placeholder rows.
+        placeholder_token_ids (list): Consecutive ids of the placeholder tokens.
+    """
+    def __init__(self, embedding, placeholder_token_ids):
+        super().__init__()
+        self.embedding = embedding
+        self.first_id = min(placeholder_token_ids)
+        self.num_vectors = max(placeholder_token_ids) - self.first_id + 1
+        rows = embedding.weight.detach()[self.first_id : self.first_id + self.num_vectors]
+        # a child after the frozen embedding, as a module yields its own parameters before the ones of its
+        # children: `parameters()` then starts with the frozen weight, and the `dtype` of the text encoder stays its own
+        self.placeholder = torch.nn.ParameterDict({"rows": torch.nn.Parameter(rows.float().clone())})
+
+    @property
+    def rows(self):
+        return self.placeholder["rows"]
+
+    @property
+    def weight(self):
+        weight = self.embedding.weight
+        return torch.cat([weight[: self.first_id], self.rows.to(weight.dtype), weight[self.first_id + self.num_vectors :]])
+
+    def forward(self, input_ids):
+        embeds = self.embedding(input_ids)
+        offsets = input_ids - self.first_id
+        is_placeholder = (offsets >= 0) & (offsets < self.num_vectors)
+        rows = self.rows.to(embeds.dtype)[offsets.clamp(0, self.num_vectors - 1)]
+        return torch.where(is_placeholder.unsqueeze(-1), rows, embeds)
+
+    def merge(self):
+        """Write the learned rows into the token embedding, and return it."""
+        with torch.no_grad():
+            self.embedding.weight[self.first_id : self.first_id + self.num_vectors] = self.rows.to(self.embedding.weight.dtype)
+        return self.embedding
@@ -0,0 +1,137 @@
+import itertools
+import time
+from collections import OrderedDict
+
+import torch
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def _modules_of(obj):
+    if isinstance(obj, torch.nn.Module):
+        return [obj]
+    # diffusers pipelines keep their models in `components`
+    components = getattr(obj, "components", None) or {}
+    return [c for c in components.values() if isinstance(c, torch.nn.Module)]
+
+
+def model_nbytes(obj):
+    """Size of the parameters and buffers of a module or a pipeline, in bytes."""
+    n_bytes = 0
+    for module in _modules_of(obj):
+        for t in itertools.chain(module.parameters(), module.buffers()):
+            n_bytes += t.numel() * t.element_size()
+    return n_bytes
+
+
+def _sync(device):
+    if torch.device(device).type == "cuda" and torch.cuda.is_available():
+        torch.cuda.synchronize(device)
+
+
+class ModelResidency:
+    """Owner of the models reused across loops.
+
+    Models are loaded once with their registered loader and never destroyed, instead
+    they are moved between the device and CPU memory. `acquire` brings a model to the
+    device, offloading the least recently used idle models when the resident ones would
+    exceed `budget_bytes` (all the idle ones before loading a model, whose size is unknown). The load and transfer times are tracked, so every loop can
+    report the time saved against reloading all its models from disk.
+
+    Args:
+        device (str): Device the acquired models are moved to.
+        budget_bytes (int): Maximum size of the models kept on the device at once,
+            None for no limit.
+    """
+    def __init__(self, device="cuda", budget_bytes=None):
+        self.device = device
+        self.budget_bytes = budget_bytes
+        self._loaders = {}
+        self._models = {}
+        self._nbytes = {}
+        self._load_time = {}
+        self._in_use = set()
+        # resident models, in least recently used order
+        self._resident = OrderedDict()
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {"load": 0.0, "transfer": 0.0, "saved": 0.0, "reused": []}
+
+    def register(self, name, loader):
+        """Register the zero-argument `loader` building the model `name` on the device."""
+        self._loaders[name] = loader
+
+    def is_loaded(self, name):
+        return name in self._models
+
+    def _move(self, name, device):
+        start = time.perf_counter()
+        self._models[name].to(device)
+        _sync(self.device)
+        elapsed = time.perf_counter() - start
+        self._stats["transfer"] += elapsed
+        return elapsed
+
+    def _make_room(self, n_bytes):
+        if self.budget_bytes is None:
+            return
+        for name in list(self._resident):
+            if sum(self._nbytes[n] for n in self._resident) + n_bytes <= self.budget_bytes:
+                break
+            if name not in self._in_use:
+                self.offload(name)
+
+    def acquire(self, name):
+        """Return the model `name` on the device, loading it on the first call."""
+        if name not in self._models:
+            # the loader builds the model on the device, whose size is only known afterwards:
+            # the idle models are offloaded first, within a budget
+            self._make_room(self.budget_bytes or 0)
+            start = time.perf_counter()
+            model = self._loaders[name]()
+            _sync(self.device)
+            self._load_time[name] = time.perf_counter() - start
+            self._stats["load"] += self._load_time[name]
+            self._models[name] = model
+            self._nbytes[name] = model_nbytes(model)
+            self._make_room(self._nbytes[name])
+            log.info(f"Loaded '{name}' ({self._nbytes[name] / 2**30:.2f} GiB) in {self._load_time[name]:.1f}s.")
+        else:
+            transfer_time = 0.0
+            if name not in self._resident:
+                self._make_room(self._nbytes[name])
+                transfer_time = self._move(name, self.device)
+            self._stats["saved"] += self._load_time[name] - transfer_time
+            self._stats["reused"].append(name)
+        self._resident[name] = True
+        self._resident.move_to_end(name)
+        self._in_use.add(name)
+        return self._models[name]
+
+    def release(self, name):
+        """Mark the model `name` as idle, it may then be offloaded to make room."""
+        self._in_use.discard(name)
+
+    def offload(self, name):
+        if name in self._resident:
+            self._move(name, "cpu")
+            del self._resident[name]
+            self._in_use.discard(name)
+
+    def offload_all(self):
+        for name in list(self._resident):
+            self.offload(name)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def report(self, prefix=""):
+        """Log the load and transfer times since the last report, and the time saved by reusing models."""
+        s = self._stats
+        reused = ", ".join(sorted(set(s["reused"]))) or "none"
+        log.info((f"{prefix}Model residency: load {s['load']:.1f}s, transfer {s['transfer']:.1f}s, "
+                  f"saved {s['saved']:.1f}s against reloading (reused: {reused})."))
+        self._reset_stats()
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import os
+
+from .image_io import write_json_atomic
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+# the configuration keys changing the pools, the clusters or the trained adapters, the other ones
+# (batch sizes, workers, backends, caches, directories) only change how fast a run gets there
+RESULT_KEYS = (
+    # model and prompt
+    "pretrained_model_name_or_path", "pretrained_vae_model_name_or_path", "character_name", "inference_prompt",
+    "learnable_property", "initializer_token", "placeholder_token", "num_vectors", "seed",
+    # pool
+    "num_of_generated_img", "infer_steps", "draft_pool", "draft_infer_steps", "draft_resolution",
+    # convergence and clustering
+    "convergence_scale", "early_stop", "early_stop_confidence", "early_stop_min_images", "distance_num_pairs",
+    "dmin_c", "dsize_c", "kmeans_n_init",
+    # training
+    "resolution", "center_crop", "random_flip", "repeats", "train_batch_size", "gradient_accumulation_steps",
+    "num_train_epochs", "max_train_steps", "checkpointing_steps", "learning_rate", "scale_lr", "lr_scheduler",
+    "lr_warmup_steps", "adam_beta1", "adam_beta2", "adam_weight_decay", "adam_epsilon", "use_8bit_adam",
+    "max_grad_norm", "noise_offset", "mixed_precision", "rank", "lora", "text_inv", "train_text_encoder",
+)
+
+
+def config_hash(args):
+    """Short hash of the `RESULT_KEYS` of a run configuration, to tell whether a saved run state belongs to it."""
+    config = json.dumps({key: getattr(args, key, None) for key in RESULT_KEYS}, sort_keys=True, default=str)
+    return hashlib.sha256(config.encode()).hexdigest()[:16]
+
+
+class RunState:
+    """Progress of the training loops of a character, saved to a json manifest after every phase.
+
+    The manifest holds the initial pairwise distance, and for every loop the finished
+    phases, the pairwise distance of its pool, the pool indices of the training set and
+    the checkpoint of the trained adapters, so that a resumed run neither recomputes nor
+    guesses them. A manifest written with another configuration is ignored.
+
+    Args:
+        path (str): Path of the json manifest.
+        config_hash (str): Hash of the configuration of the run, see `config_hash`.
+    """
+    def __init__(self, path, config_hash):
+        self.path = path
+        self.config_hash = config_hash
+        self.data = {"config_hash": config_hash, "init_dist": None, "final_dir": None, "loops": {}}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get("config_hash") == config_hash:
+                self.data = data
+                log.info(f"Loaded run state '{path}', finished loops: {self.finished_loops()}.")
+            else:
+                log.warning(f"Ignored run state '{path}', written with another configuration.")
+
+    @property
+    def init_dist(self):
+        return self.data["init_dist"]
+
+    @property
+    def final_dir(self):
+        return self.data["final_dir"]
+
+    def loop(self, loop_id):
+        """State of a loop: its finished phases and the values recorded along them."""
+        return self.data["loops"].get(str(loop_id), {"phases": []})
+
+    def is_done(self, loop_id, phase):
+        return phase in self.loop(loop_id)["phases"]
+
+    def finished_loops(self):
+        return sorted(int(loop_id) for loop_id, loop in self.data["loops"].items() if "train" in loop["phases"])
+
+    def resume_loop(self):
+        """First loop with an unfinished phase, 0 for a new run."""
+        finished = self.finished_loops()
+        return finished[-1] + 1 if finished else 0
+
+    def reset_from(self, loop_id):
+        """Forget the loops from `loop_id` on and the final model, for a run restarted at that loop."""
+        self.data["loops"] = {key: loop for key, loop in self.data["loops"].items() if int(key) < loop_id}
+        self.data["final_dir"] = None
+        if loop_id == 0:
+            self.data["init_dist"] = None
+        self.save()
+
+    def update(self, **values):
+        self.data.update(values)
+        self.save()
+
+    def complete(self, loop_id, phase, **values):
+        """Record a finished phase of a loop with its values, and save the manifest."""
+        loop = self.data["loops"].setdefault(str(loop_id), {"phases": []})
+        loop.update(values)
+        if phase not in loop["phases"]:
+            loop["phases"].append(phase)
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        write_json_atomic(self.path, self.data, indent=2)
@@ -0,0 +1,95 @@
+import time
+from collections import defaultdict
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+SCHEDULING_POLICIES = ('round_robin', 'fair_share')
+
+
+class _Job:
+    def __init__(self, name, phases):
+        self.name = name
+        self.phases = phases
+        self.phase_time = defaultdict(float)
+        self.phase_count = defaultdict(int)
+        self.last_phase = None
+        self.status = "waiting"
+        self.result = None
+
+    @property
+    def busy_time(self):
+        return sum(self.phase_time.values())
+
+
+class PhaseScheduler:
+    """Interleave the phases of several jobs in one process.
+
+    A job is a generator yielding the name of every phase it finished (see `train_loop_phases`),
+    its return value is the result of the job. Every step runs one phase of one job, picked by
+    the policy:
+        'round_robin': the active jobs in turn, one phase each.
+        'fair_share': the job with the least busy time so far, so that a job with long phases
+            does not starve the others.
+    A failing job is logged and dropped, the other jobs go on. A progress report of every job
+    is logged after each step.
+
+    Args:
+        policy (str): One of `SCHEDULING_POLICIES`.
+    """
+    def __init__(self, policy='round_robin'):
+        if policy not in SCHEDULING_POLICIES:
+            raise ValueError(f'Invalid scheduling policy: "{policy}", choose from {SCHEDULING_POLICIES}')
+        self.policy = policy
+        self.jobs = []
+        self._turn = 0
+
+    def add(self, name, phases):
+        self.jobs.append(_Job(name, phases))
+
+    def _active(self):
+        return [job for job in self.jobs if job.status in ("waiting", "running")]
+
+    def _next_job(self):
+        active = self._active()
+        if self.policy == 'fair_share':
+            return min(active, key=lambda job: job.busy_time)
+        job = active[self._turn % len(active)]
+        self._turn += 1
+        return job
+
+    def step(self):
+        """Run one phase of the next job, return False once every job ended."""
+        if not self._active():
+            return False
+        job = self._next_job()
+        job.status = "running"
+        start = time.perf_counter()
+        try:
+            phase = next(job.phases)
+        except StopIteration as stop:
+            phase, job.status, job.result = "finish", "done", stop.value
+        except Exception:
+            phase, job.status = "failed", "failed"
+            log.exception(f"Job '{job.name}' failed, the other jobs go on.")
+        job.phase_time[phase] += time.perf_counter() - start
+        job.phase_count[phase] += 1
+        job.last_phase = phase
+        if self.policy == 'round_robin' and job.status != "running":
+            # the next active job moved to the index of this one
+            self._turn -= 1
+        return True
+
+    def run(self):
+        """Run every job to its end, return the results by job name."""
+        while self.step():
+            self.report()
+        return {job.name: job.result for job in self.jobs}
+
+    def report(self):
+        for job in self.jobs:
+            phases = ", ".join(f"{phase} {job.phase_count[phase]}x {job.phase_time[phase]:.0f}s" for phase in job.phase_time)
+            log.info(f"[{job.name}] {job.status}, last phase '{job.last_phase}', busy {job.busy_time:.0f}s ({phases or '-'})")
@@ -0,0 +1,101 @@
+import os
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+PROJECTIONS = ('auto', 'tsne', 'bhtsne', 'pca')
+
+
+AUTO_MAX_POINTS = 512
+
+
+def resolve_projection(method, num_points):
+    if method == 'auto':
+        return 'tsne' if num_points <= AUTO_MAX_POINTS else 'pca'
+    return method
+
+
+def project_2d(data, method='auto', max_perplexity=30, seed=42):
+    """Project (N, D) points to 2D.
+
+    Methods:
+        'tsne': t-SNE with perplexity N - 1 (the historical setting), quadratic in N.
+        'bhtsne': Barnes-Hut t-SNE with the perplexity capped at `max_perplexity`.
+        'pca': the first two principal components, for large pools.
+        'auto': 'tsne' up to `AUTO_MAX_POINTS` points, 'pca' above.
+    """
+    method = resolve_projection(method, len(data))
+    if method == 'pca':
+        from sklearn.decomposition import PCA
+        return PCA(n_components=2, random_state=seed).fit_transform(data)
+
+    from sklearn.manifold import TSNE
+    if method == 'tsne':
+        tsne = TSNE(n_components=2, random_state=seed, perplexity=len(data) - 1)
+    elif method == 'bhtsne':
+        tsne = TSNE(n_components=2, random_state=seed, method='barnes_hut',
+                    perplexity=min(max_perplexity, len(data) - 1))
+    else:
+        raise ValueError(f'Invalid projection: "{method}", choose from {PROJECTIONS}')
+    return tsne.fit_transform(data)
+
+
+def plot_clusters(data, labels, img_path, method='auto', title=None):
+    """Scatter the 2D projection of the clustered points, one color per cluster, and save it to `img_path`."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    start = time.perf_counter()
+    method = resolve_projection(method, len(data))
+    embeddings_2d = project_2d(data, method=method)
+    fig = plt.figure(figsize=(20, 16))
+    for i in np.unique(labels):
+        cluster_points = embeddings_2d[labels == i]
+        plt.scatter(cluster_points[:, 0], cluster_points[:, 1], label=f"Cluster {i + 1}", s=100)
+    if title:
+        plt.title(title)
+    fig.savefig(img_path)
+    plt.close(fig)
+    log.info(f"Cluster visualization '{img_path}' ({len(data)} points, {method}) took {time.perf_counter() - start:.1f}s.")
+
+
+def launch_plot_clusters(data, labels, img_path, method='auto', title=None):
+    """Plot the clusters in a detached process, returning as soon as it is started.
+
+    The points are handed over through a `.npz` file next to the plot, removed by the
+    process when done. The process runs this module, so it never imports the caller.
+    """
+    # absolute paths, the process runs from the repository root
+    data_path = os.path.abspath(f"{os.path.splitext(img_path)[0]}.npz")
+    np.savez(data_path, data=data, labels=labels)
+    root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    cmd = [sys.executable, '-m', 'utils.visualization', data_path, os.path.abspath(img_path), '--method', method]
+    if title:
+        cmd += ['--title', title]
+    return subprocess.Popen(cmd, cwd=root_dir, start_new_session=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Plot clustered embeddings saved in a .npz file.")
+    parser.add_argument('data_path', type=str)
+    parser.add_argument('img_path', type=str)
+    parser.add_argument('--method', type=str, default='auto', choices=PROJECTIONS)
+    parser.add_argument('--title', type=str, default=None)
+    cmd_args = parser.parse_args()
+
+    try:
+        with np.load(cmd_args.data_path) as npz:
+            plot_clusters(npz['data'], npz['labels'], cmd_args.img_path, method=cmd_args.method, title=cmd_args.title)
+    finally:
+        os.remove(cmd_args.data_path)
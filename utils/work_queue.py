@@ -0,0 +1,225 @@
+import json
+import os
+import shutil
+import socket
+import time
+
+import numpy as np
+
+from .image_io import write_atomic, write_json_atomic
+from .logger import get_logger
+
+
+log = get_logger(__name__)
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Work queue on a shared filesystem, for workers spread over GPUs and hosts.
+
+    A job is a directory holding `job.json` (the spec shared by all its items, and the
+    items themselves), the leases of the claimed items and the results of the done ones:
+
+        <queue_dir>/<job>/job.json
+        <queue_dir>/<job>/leases/<key>.<attempt>
+        <queue_dir>/<job>/done/<key>.npy
+
+    An item is claimed by creating its next lease file with `O_EXCL`, which exactly one
+    worker wins. A lease expires `lease_seconds` after it was taken (the file mtime),
+    the item can then be claimed again under the next attempt number, so a crashed worker
+    only delays its items. Results are written atomically, an item done twice (by a slow
+    worker and the one that took over) ends with the same content.
+
+    Args:
+        queue_dir (str): Shared directory of the queue.
+        lease_seconds (float): Time after which a claimed item that is not done is free again,
+            longer than a worker needs for a batch of items.
+    """
+    def __init__(self, queue_dir, lease_seconds=600):
+        self.queue_dir = queue_dir
+        self.lease_seconds = lease_seconds
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _job_dir(self, name):
+        return os.path.join(self.queue_dir, name)
+
+    def _done_path(self, name, key):
+        return os.path.join(self._job_dir(name), "done", f"{key}.npy")
+
+    def publish(self, name, spec, items):
+        """Publish a job, `items` are dicts with a unique "key".
+
+        Republishing the same job keeps its done items, a job with another spec or
+        other items replaces the previous one.
+        """
+        job = {"spec": spec, "items": items, "created": time.time()}
+        job_path = os.path.join(self._job_dir(name), "job.json")
+        if os.path.exists(job_path):
+            prev_job = self.load_job(name)
+            if prev_job["spec"] == spec and prev_job["items"] == items:
+                log.info(f"Job '{name}' already published, {self.num_done(name)}/{len(items)} items done.")
+                return
+            shutil.rmtree(self._job_dir(name))
+        for sub_dir in ("leases", "done"):
+            os.makedirs(os.path.join(self._job_dir(name), sub_dir), exist_ok=True)
+        # job.json comes last, workers never see a job without its directories
+        write_json_atomic(job_path, job)
+        log.info(f"Published job '{name}' with {len(items)} items to '{self.queue_dir}'.")
+
+    def load_job(self, name):
+        with open(os.path.join(self._job_dir(name), "job.json"), 'r') as f:
+            return json.load(f)
+
+    def jobs(self):
+        """Names of the published jobs, oldest first."""
+        names = [name for name in os.listdir(self.queue_dir)
+                 if os.path.exists(os.path.join(self._job_dir(name), "job.json"))]
+        return sorted(names, key=lambda name: os.path.getmtime(os.path.join(self._job_dir(name), "job.json")))
+
+    def is_done(self, name, key):
+        return os.path.exists(self._done_path(name, key))
+
+    def num_done(self, name):
+        return sum(1 for file_name in os.listdir(os.path.join(self._job_dir(name), "done"))
+                   if file_name.endswith(".npy") and not file_name.startswith('.'))
+
+    def _latest_lease(self, name, key):
+        lease_dir = os.path.join(self._job_dir(name), "leases")
+        attempts = [int(file_name.rsplit('.', 1)[1]) for file_name in os.listdir(lease_dir)
+                    if file_name.rsplit('.', 1)[0] == str(key)]
+        if not attempts:
+            return 0, None
+        attempt = max(attempts)
+        return attempt, os.path.join(lease_dir, f"{key}.{attempt}")
+
+    def _try_lease(self, name, key, worker_id):
+        attempt, lease_path = self._latest_lease(name, key)
+        if lease_path is not None:
+            try:
+                if time.time() - os.path.getmtime(lease_path) < self.lease_seconds:
+                    return False
+            except FileNotFoundError:
+                return False
+        new_lease_path = os.path.join(self._job_dir(name), "leases", f"{key}.{attempt + 1}")
+        try:
+            fd = os.open(new_lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # another worker claimed it first
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(worker_id)
+        if attempt > 0:
+            log.warning(f"Job '{name}' item {key}: lease {attempt} expired, taken over by {worker_id}.")
+        return True
+
+    def claim(self, name, worker_id, max_items=1):
+        """Lease up to `max_items` items of the job that are neither done nor leased, in item order."""
+        claimed = []
+        for item in self.load_job(name)["items"]:
+            if len(claimed) >= max_items:
+                break
+            if not self.is_done(name, item["key"]) and self._try_lease(name, item["key"], worker_id):
+                # it may have been completed between the two checks
+                if self.is_done(name, item["key"]):
+                    continue
+                claimed.append(item)
+        return claimed
+
+    def complete(self, name, item, result):
+        """Store the result of an item (a numpy array), marking it as done."""
+        def _save(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(result))
+        write_atomic(self._done_path(name, item["key"]), _save)
+
+    def results(self, name):
+        """Results of the items, in item order, None for the ones not done yet."""
+        return [np.load(self._done_path(name, item["key"])) if self.is_done(name, item["key"]) else None
+                for item in self.load_job(name)["items"]]
+
+    def wait(self, name, poll_interval=5.0, timeout=None):
+        """Block until every item of the job is done, return the results in item order."""
+        start = time.perf_counter()
+        num_items = len(self.load_job(name)["items"])
+        last_done = -1
+        while True:
+            num_done = self.num_done(name)
+            if num_done >= num_items:
+                break
+            if num_done != last_done:
+                log.info(f"Job '{name}': {num_done}/{num_items} items done.")
+                last_done = num_done
+            if timeout is not None and time.perf_counter() - start > timeout:
+                raise TimeoutError(f"Job '{name}' not done after {timeout}s ({num_done}/{num_items} items).")
+            time.sleep(poll_interval)
+        log.info(f"Job '{name}': {num_items} items done in {time.perf_counter() - start:.1f}s.")
+        return self.results(name)
+
+    def open(self):
+        """Undo `close`, for a coordinator restarting on the same queue."""
+        if self.closed:
+            os.remove(os.path.join(self.queue_dir, "closed.json"))
+
+    def close(self):
+        """Tell the workers that no job will be published anymore."""
+        write_json_atomic(os.path.join(self.queue_dir, "closed.json"), {"closed": time.time()})
+
+    @property
+    def closed(self):
+        return os.path.exists(os.path.join(self.queue_dir, "closed.json"))
+
+
+def run_worker(queue, prepare_fn, process_fn, worker_id=None, batch_size=1, poll_interval=5.0, idle_timeout=None):
+    """Claim and process the items of the published jobs until the queue is closed.
+
+    Args:
+        queue (WorkQueue): The shared queue.
+        prepare_fn (callable): Called with the spec of a job before processing its first item,
+            e.g. to load the adapters of a loop, only when the spec changes (a job republished
+            under the same name with another spec is prepared again).
+        process_fn (callable): Called with (spec, items), returns one result per item.
+        worker_id (str): Name of the worker in the leases, host and pid by default.
+        batch_size (int or AdaptiveBatchSize): Number of items claimed at once.
+        poll_interval (float): Sleep between two scans of an idle queue.
+        idle_timeout (float): Exit after being idle that long, never by default.
+    """
+    worker_id = worker_id or default_worker_id()
+    current_spec, num_items = None, 0
+    idle_since = time.perf_counter()
+    log.info(f"Worker {worker_id} polling '{queue.queue_dir}'.")
+    while not queue.closed:
+        claimed = False
+        for name in queue.jobs():
+            max_items = getattr(batch_size, "size", batch_size)
+            try:
+                items = queue.claim(name, worker_id, max_items=max_items)
+                if not items:
+                    continue
+                spec = queue.load_job(name)["spec"]
+                if spec != current_spec:
+                    prepare_fn(spec)
+                    current_spec = spec
+                start = time.perf_counter()
+                for item, result in zip(items, process_fn(spec, items)):
+                    queue.complete(name, item, result)
+            except FileNotFoundError as err:
+                # the coordinator replaced the job meanwhile
+                log.warning(f"Worker {worker_id}: job '{name}' is gone ({err}).")
+                current_spec = None
+                break
+            num_items += len(items)
+            log.info(f"Worker {worker_id}: job '{name}' items {[item['key'] for item in items]} "
+                     f"done in {time.perf_counter() - start:.1f}s.")
+            claimed = True
+            break
+        if claimed:
+            idle_since = time.perf_counter()
+            continue
+        if idle_timeout is not None and time.perf_counter() - idle_since > idle_timeout:
+            break
+        time.sleep(poll_interval)
+    log.info(f"Worker {worker_id} stopped after {num_items} items.")
+    return num_items